@@ -1,14 +1,24 @@
 import asyncio
 import logging
+import signal
 import sys
+from contextlib import suppress
+from aiohttp import web
 from aiogram import Bot, Dispatcher
 from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.exceptions import TelegramAPIError
 
 import config
-from database import db
+from database import db, MongoStorage
 from handlers import user_handlers, admin_handlers, text_handlers
 from utils.text_manager import load_texts, initialize_texts
+from utils.sleep_mode import sleep_state
+from utils.broadcast import broadcast_manager
+from utils.outbox import outbox_worker
+from utils.rate_limit import RateLimitMiddleware, create_rate_limiter
+from utils.user_session import UserSessionMiddleware, user_sessions
+from utils.user_lock import UserLockMiddleware, user_locks
+from utils.webhook import WebhookServer
 
 logging.getLogger("aiogram").setLevel(logging.WARNING)
 
@@ -23,7 +33,7 @@ def setup_logging():
     )
     return logging.getLogger(__name__)
 
-async def on_startup():
+async def on_startup(bot: Bot):
     """Perform startup actions"""
     try:
         # Initialize database connection
@@ -34,6 +44,18 @@ async def on_startup():
         await initialize_texts()
         await load_texts()
         logging.info("Texts initialized and loaded to cache")
+
+        # Load sleep mode state to cache and watch for changes
+        await sleep_state.start()
+
+        # Resume broadcasts interrupted by a restart
+        await broadcast_manager.resume(bot)
+
+        # Deliver queued notifications in the background
+        await outbox_worker.start(bot)
+
+        # Drop cached user documents when they are written outside a session
+        user_sessions.start()
         
     except Exception as e:
         logging.error(f"Error during startup: {e}")
@@ -42,12 +64,55 @@ async def on_startup():
 async def on_shutdown():
     """Perform cleanup actions"""
     try:
+        await sleep_state.stop()
+        await broadcast_manager.stop()
+        await outbox_worker.stop()
+        user_sessions.stop()
+        logging.info(f"User lock wait stats: {user_locks.stats()}")
+
         # Close database connection
         await db.close()
         logging.info("Database connection closed")
     except Exception as e:
         logging.error(f"Error during shutdown: {e}")
 
+async def run_webhook(dp: Dispatcher, bot: Bot, logger: logging.Logger):
+    """Serve updates through an aiohttp webhook endpoint until SIGTERM/SIGINT"""
+    if not config.WEBHOOK_BASE_URL:
+        raise ValueError("WEBHOOK_BASE_URL must be set for webhook mode")
+    if not config.WEBHOOK_SECRET:
+        # Without a secret the public endpoint would accept forged updates, admin callbacks included
+        raise ValueError("WEBHOOK_SECRET must be set for webhook mode")
+
+    server = WebhookServer(dp, bot, config.WEBHOOK_PATH, config.WEBHOOK_SECRET)
+    runner = web.AppRunner(server.build_app())
+    await runner.setup()
+
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    with suppress(NotImplementedError):  # Signals handling is not supported on Windows
+        loop.add_signal_handler(signal.SIGTERM, stop_event.set)
+        loop.add_signal_handler(signal.SIGINT, stop_event.set)
+
+    await dp.emit_startup(bot=bot, dispatcher=dp, bots=[bot])
+    try:
+        site = web.TCPSite(runner, config.WEBAPP_HOST, config.WEBAPP_PORT)
+        await site.start()
+
+        # Pending updates are kept by Telegram while the bot restarts
+        await bot.set_webhook(
+            url=config.WEBHOOK_BASE_URL.rstrip("/") + config.WEBHOOK_PATH,
+            secret_token=config.WEBHOOK_SECRET,
+            allowed_updates=dp.resolve_used_update_types(),
+            drop_pending_updates=False
+        )
+        logger.info(f"Webhook server listening on {config.WEBAPP_HOST}:{config.WEBAPP_PORT}")
+        await stop_event.wait()
+    finally:
+        await server.drain(config.WEBHOOK_DRAIN_TIMEOUT)
+        await runner.cleanup()
+        await dp.emit_shutdown(bot=bot, dispatcher=dp, bots=[bot])
+
 async def main():
     # Setup logging
     logger = setup_logging()
@@ -55,7 +120,7 @@ async def main():
     try:
         # Initialize bot and dispatcher
         bot = Bot(token=config.BOT_TOKEN)
-        storage = MemoryStorage()
+        storage = MongoStorage(db) if config.FSM_STORAGE == "mongo" else MemoryStorage()
         dp = Dispatcher(storage=storage)
         
         # Register routers
@@ -63,15 +128,30 @@ async def main():
         dp.include_router(admin_handlers.router)
         dp.include_router(text_handlers.router)
         
-        # Запуск периодической очистки rate limit и корзин
-        await user_handlers.init_rate_limit_cleanup(bot)
+        # Updates of one user are processed one at a time, different users in parallel
+        dp.update.outer_middleware(UserLockMiddleware(user_locks))
+
+        # Rate limiting for handlers flagged with rate_limit
+        dp.callback_query.middleware(RateLimitMiddleware(create_rate_limiter(config.RATE_LIMIT_BACKEND)))
+
+        # One user document per update, loaded lazily and written back as dirty fields
+        dp.message.middleware(UserSessionMiddleware(user_sessions))
+        dp.callback_query.middleware(UserSessionMiddleware(user_sessions))
+
+        # Запуск периодической очистки корзин
+        await user_handlers.init_cart_cleanup()
         # Register startup and shutdown handlers
         dp.startup.register(on_startup)
         dp.shutdown.register(on_shutdown)
         
-        # Start polling
-        logger.info("Starting bot...")
-        await dp.start_polling(bot, skip_updates=True)
+        if config.BOT_MODE == "webhook":
+            logger.info("Starting bot in webhook mode...")
+            await run_webhook(dp, bot, logger)
+        else:
+            # Start polling (a webhook left from webhook mode would block getUpdates)
+            logger.info("Starting bot...")
+            await bot.delete_webhook(drop_pending_updates=False)
+            await dp.start_polling(bot, skip_updates=True)
     except Exception as e:
         logger.critical(f"Critical error while running bot: {e}")
         sys.exit(1)
@@ -21,6 +21,21 @@ ADMIN_CARD_NAME: str = os.getenv("ADMIN_CARD_NAME", "")  # OK
 MONGODB_URI: str = require_env_var("MONGODB_URI")
 DB_NAME: str = "vapeshop_db"
 
+# Update delivery: "polling" (default, for local runs) or "webhook"
+BOT_MODE: str = os.getenv("BOT_MODE", "polling")
+WEBHOOK_BASE_URL: str = os.getenv("WEBHOOK_BASE_URL", "")  # Публичный https-адрес приложения
+WEBHOOK_PATH: str = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET: str = os.getenv("WEBHOOK_SECRET", "")  # Обязателен в режиме webhook
+WEBAPP_HOST: str = os.getenv("WEBAPP_HOST", "0.0.0.0")
+WEBAPP_PORT: int = int(os.getenv("PORT", "8080"))
+WEBHOOK_DRAIN_TIMEOUT: float = float(os.getenv("WEBHOOK_DRAIN_TIMEOUT", "25"))
+
+# FSM storage: "mongo" (persistent, survives restarts) or "memory"
+FSM_STORAGE: str = os.getenv("FSM_STORAGE", "mongo")
+
+# Button rate limiting: "memory" (per process) or "mongo" (shared by all instances)
+RATE_LIMIT_BACKEND: str = os.getenv("RATE_LIMIT_BACKEND", "memory")
+
 # Shop Configuration
 SHOP_NAME: str = "VapeShop"
 # Product Categories
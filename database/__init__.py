@@ -1,3 +1,4 @@
 from .mongodb import db
+from .fsm_storage import MongoStorage
 
-__all__ = ['db'] 
\ No newline at end of file
+__all__ = ['db', 'MongoStorage']
\ No newline at end of file
@@ -0,0 +1,89 @@
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+from collections import OrderedDict
+from datetime import datetime
+from typing import Any, Dict, Optional
+import logging
+import time
+
+from .mongodb import db as default_db
+
+logger = logging.getLogger(__name__)
+
+
+class MongoStorage(BaseStorage):
+    """
+    FSM storage in MongoDB (collection fsm_states) with a write-through in-process LRU.
+    Reads are served from memory; every write goes to MongoDB first, so states survive
+    restarts. Stale documents are removed by the TTL index on updated_at.
+    cache_ttl bounds how long a cached entry is trusted when several workers share the storage.
+    """
+
+    def __init__(self, database=default_db, cache_size: int = 10000, cache_ttl: float = 30):
+        self._database = database
+        self._cache_size = cache_size
+        self._cache_ttl = cache_ttl
+        self._cache: "OrderedDict[str, tuple]" = OrderedDict()  # {doc_id: (loaded_at, state, data)}
+
+    @staticmethod
+    def _doc_id(key: StorageKey) -> str:
+        return f"{key.bot_id}:{key.chat_id}:{key.user_id}:{key.thread_id or ''}:{key.destiny}"
+
+    @property
+    def _collection(self):
+        return self._database.fsm_states
+
+    def _remember(self, doc_id: str, state: Optional[str], data: Dict[str, Any]):
+        self._cache[doc_id] = (time.monotonic(), state, data)
+        self._cache.move_to_end(doc_id)
+        while len(self._cache) > self._cache_size:
+            self._cache.popitem(last=False)
+
+    async def _load(self, doc_id: str) -> tuple:
+        cached = self._cache.get(doc_id)
+        if cached is not None and time.monotonic() - cached[0] < self._cache_ttl:
+            self._cache.move_to_end(doc_id)
+            return cached[1], cached[2]
+
+        await self._database.ensure_connected()
+        doc = await self._collection.find_one({"_id": doc_id})
+        state = doc.get("state") if doc else None
+        data = doc.get("data", {}) if doc else {}
+        self._remember(doc_id, state, data)
+        return state, data
+
+    async def _save(self, doc_id: str, state: Optional[str], data: Dict[str, Any]):
+        await self._database.ensure_connected()
+        if state is None and not data:
+            # Empty context — no need to keep the document
+            await self._collection.delete_one({"_id": doc_id})
+        else:
+            await self._collection.update_one(
+                {"_id": doc_id},
+                {"$set": {"state": state, "data": data, "updated_at": datetime.now()}},
+                upsert=True
+            )
+        self._remember(doc_id, state, data)
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        doc_id = self._doc_id(key)
+        _, data = await self._load(doc_id)
+        new_state = state.state if isinstance(state, State) else state
+        await self._save(doc_id, new_state, data)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        state, _ = await self._load(self._doc_id(key))
+        return state
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        doc_id = self._doc_id(key)
+        state, _ = await self._load(doc_id)
+        await self._save(doc_id, state, data.copy())
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        _, data = await self._load(self._doc_id(key))
+        return data.copy()
+
+    async def close(self) -> None:
+        # The MongoDB client is shared with the rest of the bot and closed in on_shutdown
+        self._cache.clear()
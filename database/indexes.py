@@ -0,0 +1,155 @@
+from pymongo import ASCENDING, DESCENDING, IndexModel
+from bson import ObjectId
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Reservations past due by more than this are garbage-collected by the TTL index
+CART_RESERVATION_TTL_SECONDS = 24 * 60 * 60
+# FSM states untouched for this long are removed by the TTL index
+FSM_STATE_TTL_SECONDS = 7 * 24 * 60 * 60
+# Idle rate-limit buckets are full again long before this and can be dropped
+RATE_LIMIT_TTL_SECONDS = 60 * 60
+# Delivered or failed notifications are kept this long for inspection
+OUTBOX_TTL_SECONDS = 7 * 24 * 60 * 60
+
+# Users whose cart is non-empty (one-off cart reservation backfill)
+NON_EMPTY_CART_FILTER = {"cart.0": {"$exists": True}}
+
+# Options that make two indexes with the same name different
+INDEX_OPTIONS = ("unique", "sparse", "expireAfterSeconds", "partialFilterExpression")
+
+# Declared indexes per collection; anything missing or changed is rebuilt at startup
+INDEXES = {
+    "products": [
+        IndexModel([("name", ASCENDING)]),
+        IndexModel([("category", ASCENDING)]),
+    ],
+    "orders": [
+        IndexModel([("user_id", ASCENDING)]),
+        # Active-order counting and the status-filtered order list (newest first)
+        IndexModel([("status", ASCENDING), ("created_at", DESCENDING), ("_id", DESCENDING)]),
+        # Unfiltered order list, newest first, with a unique tie-breaker for keyset paging
+        IndexModel([("created_at", DESCENDING), ("_id", DESCENDING)]),
+        # Checkout idempotency: a redelivered update cannot create a second order
+        IndexModel(
+            [("idempotency_key", ASCENDING)],
+            unique=True,
+            partialFilterExpression={"idempotency_key": {"$exists": True}}
+        ),
+    ],
+    "users": [
+        IndexModel([("user_id", ASCENDING)], unique=True),
+    ],
+    "settings": [
+        # One document per setting: concurrent first upserts of a counter cannot duplicate it
+        IndexModel([("setting", ASCENDING)], unique=True),
+    ],
+    "broadcasts": [
+        IndexModel([("status", ASCENDING)]),
+    ],
+    "fsm_states": [
+        IndexModel([("updated_at", ASCENDING)], expireAfterSeconds=FSM_STATE_TTL_SECONDS),
+    ],
+    "outbox": [
+        IndexModel([("status", ASCENDING), ("next_attempt_at", ASCENDING)]),
+        IndexModel([("status", ASCENDING), ("locked_until", ASCENDING)]),
+        IndexModel([("finished_at", ASCENDING)], expireAfterSeconds=OUTBOX_TTL_SECONDS),
+    ],
+    "rate_limits": [
+        IndexModel([("updated_at", ASCENDING)], expireAfterSeconds=RATE_LIMIT_TTL_SECONDS),
+    ],
+    "cart_reservations": [
+        IndexModel([("user_id", ASCENDING)], unique=True),
+        # Range queries on due reservations; TTL only collects leftovers the scheduler missed
+        IndexModel([("expires_at", ASCENDING)], expireAfterSeconds=CART_RESERVATION_TTL_SECONDS),
+    ],
+}
+
+# Hot query shapes checked with explain at startup: (collection, filter, sort, hint)
+REGISTERED_QUERIES = [
+    ("products", {"category": ""}, None, None),
+    # Stock updates match the product by _id and the flavor by name
+    ("products", {"_id": ObjectId(), "flavors.name": ""}, None, None),
+    ("orders", {"status": {"$in": ["pending", "confirmed"]}}, None, None),
+    ("orders", {}, [("created_at", DESCENDING), ("_id", DESCENDING)], None),
+    # Filtered order dashboard page
+    ("orders", {"status": "pending", "created_at": {"$gte": 0}}, [("created_at", DESCENDING), ("_id", DESCENDING)], None),
+    ("orders", {"user_id": 0}, None, None),
+    ("users", {"user_id": 0}, None, None),
+    ("cart_reservations", {"expires_at": {"$lte": 0}}, [("expires_at", ASCENDING)], None),
+]
+
+
+def _index_differs(existing: dict, spec: dict) -> bool:
+    if [tuple(key) for key in existing.get("key", [])] != [
+        (field, direction) for field, direction in spec["key"].items()
+    ]:
+        return True
+    return any(existing.get(option) != spec.get(option) for option in INDEX_OPTIONS)
+
+
+async def ensure_indexes(database):
+    """Create missing indexes and rebuild those whose definition changed"""
+    for collection_name, models in INDEXES.items():
+        collection = database[collection_name]
+        existing = await collection.index_information()
+        declared = set()
+
+        for model in models:
+            spec = model.document
+            declared.add(spec["name"])
+            current = existing.get(spec["name"])
+
+            if current is not None and not _index_differs(current, spec):
+                continue
+
+            if current is not None:
+                logger.info(f"🔄 Rebuilding index {collection_name}.{spec['name']}")
+                await collection.drop_index(spec["name"])
+            await collection.create_indexes([model])
+            logger.info(f"✅ Created index {collection_name}.{spec['name']}")
+
+        for name in existing:
+            if name != "_id_" and name not in declared:
+                logger.warning(f"⚠️ Index {collection_name}.{name} is not declared in database/indexes.py")
+
+
+def _plan_stages(plan: dict):
+    yield plan.get("stage")
+    for child in ("inputStage", "queryPlan"):
+        if child in plan:
+            yield from _plan_stages(plan[child])
+    for child_plan in plan.get("inputStages", []):
+        yield from _plan_stages(child_plan)
+
+
+async def check_query_plans(database) -> list:
+    """
+    Explain every registered query shape (queryPlanner verbosity, nothing is executed)
+    and log the ones that would scan a whole collection. Returns the offending shapes.
+    """
+    collscans = []
+    explained = 0
+    for collection_name, query, sort, hint in REGISTERED_QUERIES:
+        find = {"find": collection_name, "filter": query}
+        if sort:
+            find["sort"] = dict(sort)
+        if hint:
+            find["hint"] = hint
+
+        try:
+            explain = await database.command({"explain": find, "verbosity": "queryPlanner"})
+        except Exception as e:
+            logger.warning(f"⚠️ Could not explain query on {collection_name} {query}: {str(e)}")
+            continue
+
+        explained += 1
+        winning_plan = explain.get("queryPlanner", {}).get("winningPlan", {})
+        if "COLLSCAN" in _plan_stages(winning_plan):
+            logger.warning(f"⚠️ COLLSCAN on {collection_name}: filter={query} sort={sort}")
+            collscans.append((collection_name, query, sort))
+
+    if explained and not collscans:
+        logger.info("✅ All registered queries use indexes")
+    return collscans
@@ -1,19 +1,33 @@
 from motor.motor_asyncio import AsyncIOMotorClient
-from pymongo.errors import ServerSelectionTimeoutError, ConnectionFailure
+from pymongo import DeleteOne, ReturnDocument, UpdateOne
+from pymongo.errors import (
+    ServerSelectionTimeoutError, ConnectionFailure, BulkWriteError, DuplicateKeyError, OperationFailure
+)
 from bson import ObjectId
 import logging
 from config import MONGODB_URI, DB_NAME
 from contextlib import asynccontextmanager
-from datetime import datetime
+from datetime import datetime, timedelta
 from bson.objectid import ObjectId
+from .product_cache import ProductCache
+from .views import resolve_projection
+from .indexes import ensure_indexes, check_query_plans, NON_EMPTY_CART_FILTER
 
 logger = logging.getLogger(__name__)
 
+# Documents fetched per round trip by the iter_* streaming readers
+DEFAULT_BATCH_SIZE = 500
+
+# Statuses counted towards the ADMIN_SWITCHING sleep-mode threshold
+ACTIVE_ORDER_STATUSES = ("pending", "confirmed")
+
 class MongoDB:
     def __init__(self):
         self._client = None
         self._db = None
         self._connected = False
+        self._write_listeners = []
+        self._product_cache = ProductCache()
 
     @property
     def db(self):
@@ -41,6 +55,70 @@ class MongoDB:
     def settings(self):
         return self.db.settings
 
+    @property
+    def broadcasts(self):
+        if self._db is None:
+            raise ConnectionError("❌ Database connection not established")
+        return self._db.broadcasts
+
+    @property
+    def fsm_states(self):
+        if self._db is None:
+            raise ConnectionError("❌ Database connection not established")
+        return self._db.fsm_states
+
+    @property
+    def cart_reservations(self):
+        if self._db is None:
+            raise ConnectionError("❌ Database connection not established")
+        return self._db.cart_reservations
+
+    @property
+    def rate_limits(self):
+        if self._db is None:
+            raise ConnectionError("❌ Database connection not established")
+        return self._db.rate_limits
+
+    @property
+    def outbox(self):
+        if self._db is None:
+            raise ConnectionError("❌ Database connection not established")
+        return self._db.outbox
+
+    async def _run_transaction(self, func):
+        """
+        Run `await func(session)` inside a transaction and return (result, True).
+        Transient errors retry the whole function, so it must not have side effects outside the session.
+        Standalone servers reject transactions before anything is written; then
+        `await func(None)` runs without one and (result, False) is returned.
+        """
+        try:
+            async with await self._client.start_session() as session:
+                return await session.with_transaction(func), True
+        except OperationFailure as e:
+            if e.code != 20 and "Transaction numbers" not in str(e):
+                raise
+            logger.warning(f"⚠️ Transactions unavailable, running without one: {str(e)}")
+            return await func(None), False
+
+    def add_write_listener(self, callback):
+        """Register a callback(collection, key) invoked after successful writes"""
+        if callback not in self._write_listeners:
+            self._write_listeners.append(callback)
+
+    def remove_write_listener(self, callback):
+        """Unregister a previously added write listener"""
+        if callback in self._write_listeners:
+            self._write_listeners.remove(callback)
+
+    def _notify_write(self, collection, key=None):
+        """Notify listeners that a collection was modified by this process"""
+        for callback in list(self._write_listeners):
+            try:
+                callback(collection, key)
+            except Exception as e:
+                logger.error("❌ Write listener failed for '%s': %s", collection, str(e))
+
     async def ensure_connected(self):
         """Ensure database connection is established"""
         if not self._connected or self._db is None:
@@ -78,19 +156,35 @@ class MongoDB:
             raise
 
     async def _create_indexes(self):
-        """Create necessary database indexes"""
+        """Reconcile the indexes declared in database/indexes.py and check the hot query plans"""
         if self._db is None:
             raise ConnectionError("❌ Cannot create indexes: no database connection")
 
         try:
-            await self.products.create_index("name")
-            await self.orders.create_index("user_id")
-            await self.users.create_index("user_id", unique=True)
+            await self._dedupe_settings()
+            await ensure_indexes(self._db)
             logger.info("✅ Database indexes created successfully")
         except Exception as e:
             logger.error("❌ Failed to create indexes [%s]: %s", type(e).__name__, str(e))
             raise
 
+        # The self-check only reports; a failure here must not block startup
+        try:
+            await check_query_plans(self._db)
+        except Exception as e:
+            logger.warning(f"⚠️ Query plan self-check failed: {str(e)}")
+
+    async def _dedupe_settings(self):
+        """Keep the oldest document per setting so the unique setting index can be built"""
+        duplicates = self.settings.aggregate([
+            {"$sort": {"_id": 1}},
+            {"$group": {"_id": "$setting", "ids": {"$push": "$_id"}, "count": {"$sum": 1}}},
+            {"$match": {"count": {"$gt": 1}}}
+        ])
+        async for group in duplicates:
+            result = await self.settings.delete_many({"_id": {"$in": group["ids"][1:]}})
+            logger.warning(f"⚠️ Removed {result.deleted_count} duplicate '{group['_id']}' settings")
+
     async def _init_settings(self):
         """Initialize settings collection with default values if empty"""
         if self._db is None:
@@ -98,15 +192,17 @@ class MongoDB:
 
         try:
             # Check if sleep_mode setting exists
-            sleep_mode = await self.settings.find_one({"setting": "sleep_mode"})
-            if not sleep_mode:
-                # Create default sleep mode settings
-                await self.settings.insert_one({
-                    "setting": "sleep_mode",
-                    "enabled": False,
-                    "end_time": None
-                })
+            # Create default sleep mode settings (upsert: the setting key is unique)
+            result = await self.settings.update_one(
+                {"setting": "sleep_mode"},
+                {"$setOnInsert": {"enabled": False, "end_time": None}},
+                upsert=True
+            )
+            if result.upserted_id is not None:
                 logger.info("✅ Initialized default sleep mode settings")
+
+            # Reconcile the active orders counter with the orders collection
+            await self._reseed_active_orders_counter()
         except Exception as e:
             logger.error("❌ Error initializing settings [%s]: %s", type(e).__name__, str(e))
             raise
@@ -122,6 +218,7 @@ class MongoDB:
         try:
             result = await self.db.users.insert_one(user_data)
             user_data['_id'] = str(result.inserted_id)
+            self._notify_write("users", user_data.get('user_id'))
             return user_data
         except Exception as e:
             logger.error(f"❌ Error creating user: {str(e)}")
@@ -143,26 +240,323 @@ class MongoDB:
                 {"user_id": user_id},
                 {"$set": update_data}
             )
+            if 'cart_expires_at' in update_data or update_data.get('cart') == []:
+                await self._sync_cart_reservation(user_id, update_data)
+            self._notify_write("users", user_id)
             return result.modified_count > 0
         except Exception as e:
             logger.error(f"❌ Error updating user {user_id}: {str(e)}")
             return False
 
-    async def get_all_users(self):
-        """Get all users from the database"""
+    async def _sync_cart_reservation(self, user_id, update_data):
+        """Mirror the user's cart_expires_at into the indexed reservations collection"""
         try:
-            cursor = self.db.users.find()
-            users = await cursor.to_list(length=None)
-            for user in users:
-                user['_id'] = str(user['_id'])
-            return users
+            expires_at = update_data.get('cart_expires_at')
+            if update_data.get('cart') == [] or not expires_at:
+                await self.cart_reservations.delete_one({"user_id": user_id})
+                return
+
+            if isinstance(expires_at, str):
+                expires_at = datetime.fromisoformat(expires_at)
+            await self.cart_reservations.update_one(
+                {"user_id": user_id},
+                {"$set": {"expires_at": expires_at}},
+                upsert=True
+            )
+        except Exception as e:
+            logger.error(f"❌ Error syncing cart reservation for user {user_id}: {str(e)}")
+
+    async def get_due_cart_reservations(self, now: datetime, limit: int = 500):
+        """Get user_ids whose cart reservation has expired (indexed range query)"""
+        try:
+            cursor = self.cart_reservations.find(
+                {"expires_at": {"$lte": now}},
+                {"user_id": 1, "_id": 0}
+            ).sort("expires_at", 1).limit(limit)
+            return [doc['user_id'] async for doc in cursor]
         except Exception as e:
-            logger.error(f"❌ Error getting all users: {str(e)}")
+            logger.error(f"❌ Failed to get due cart reservations: {str(e)}")
             return []
-    
+
+    async def get_next_cart_expiry(self):
+        """Get the earliest reservation deadline, or None if there are no reservations"""
+        try:
+            doc = await self.cart_reservations.find_one(
+                {},
+                {"expires_at": 1, "_id": 0},
+                sort=[("expires_at", 1)]
+            )
+            return doc['expires_at'] if doc else None
+        except Exception as e:
+            logger.error(f"❌ Failed to get next cart expiry: {str(e)}")
+            return None
+
+    async def _take_cart(self, user_id, query: dict = None):
+        """Atomically empty a non-empty cart matching query and return the removed items (or None)"""
+        user = await self.db.users.find_one_and_update(
+            {"user_id": user_id, "cart.0": {"$exists": True}, **(query or {})},
+            {"$set": {"cart": [], "cart_expires_at": None}},
+            projection={"cart": 1},
+            return_document=ReturnDocument.BEFORE
+        )
+        if user:
+            self._notify_write("users", user_id)
+        return user.get('cart') if user else None
+
+    async def take_expired_cart(self, user_id, now: datetime):
+        """
+        Atomically empty a user's cart if it has expired.
+        Returns the removed cart items, or None if the cart is empty or still valid.
+        """
+        try:
+            return await self._take_cart(
+                user_id, {"cart_expires_at": {"$ne": None, "$lte": now.isoformat()}}
+            )
+        except Exception as e:
+            logger.error(f"❌ Failed to take expired cart for user {user_id}: {str(e)}")
+            return None
+
+    async def take_cart(self, user_id):
+        """
+        Atomically empty a user's cart on request and drop its reservation.
+        Returns the removed cart items (only these must be released), None if the cart is
+        already empty (e.g. taken by the expiry sweeper), or False if the write failed.
+        """
+        try:
+            cart = await self._take_cart(user_id)
+            if cart:
+                await self._sync_cart_reservation(user_id, {"cart": []})
+            return cart
+        except Exception as e:
+            logger.error(f"❌ Failed to take cart for user {user_id}: {str(e)}")
+            return False
+
+    async def _update_cart(self, user_id, query, update, array_filters=None):
+        """
+        Apply a delta update to a user's cart and return {"cart", "cart_expires_at"} after it,
+        or None if the guard in query did not match.
+        """
+        user = await self.db.users.find_one_and_update(
+            {"user_id": user_id, **query},
+            update,
+            projection={"cart": 1, "cart_expires_at": 1, "_id": 0},
+            array_filters=array_filters,
+            return_document=ReturnDocument.AFTER
+        )
+        if user is None:
+            return None
+
+        cart = {"cart": user.get("cart", []), "cart_expires_at": user.get("cart_expires_at")}
+        if not cart["cart"] and cart["cart_expires_at"]:
+            # An emptied cart has nothing left to expire
+            await self.db.users.update_one(
+                {"user_id": user_id, "cart.0": {"$exists": False}},
+                {"$set": {"cart_expires_at": None}}
+            )
+            cart["cart_expires_at"] = None
+        await self._sync_cart_reservation(user_id, cart)
+        self._notify_write("users", user_id)
+        return cart
+
+    async def add_cart_line(self, user_id, line: dict, expires_at: str):
+        """
+        Push a cart line unless the cart already has one for the same product and flavor.
+        Returns the cart after the update, None if the line is a duplicate, or False if the write failed.
+        """
+        try:
+            line_match = {"product_id": line["product_id"], "flavor": line.get("flavor")}
+            return await self._update_cart(
+                user_id,
+                {"cart": {"$not": {"$elemMatch": line_match}}},
+                {"$push": {"cart": line}, "$set": {"cart_expires_at": expires_at}}
+            )
+        except Exception as e:
+            logger.error(f"❌ Error adding cart line for user {user_id}: {str(e)}")
+            return False
+
+    async def change_cart_quantity(self, user_id, product_id, flavor, delta: int, expires_at: str):
+        """
+        Change the quantity of one cart line by delta; a decrement never goes below 1.
+        Returns the cart after the update, or None if there is no such line.
+        """
+        try:
+            line_match = {"product_id": product_id, "flavor": flavor}
+            if delta < 0:
+                line_match["quantity"] = {"$gt": -delta}
+            return await self._update_cart(
+                user_id,
+                {"cart": {"$elemMatch": line_match}},
+                {"$inc": {"cart.$[line].quantity": delta}, "$set": {"cart_expires_at": expires_at}},
+                array_filters=[{"line.product_id": product_id, "line.flavor": flavor}]
+            )
+        except Exception as e:
+            logger.error(f"❌ Error changing cart quantity for user {user_id}: {str(e)}")
+            return None
+
+    async def remove_cart_line(self, user_id, product_id, flavor, expires_at: str):
+        """
+        Pull one cart line. Returns the cart after the update, or None if there is no such line.
+        """
+        try:
+            line_match = {"product_id": product_id, "flavor": flavor}
+            return await self._update_cart(
+                user_id,
+                {"cart": {"$elemMatch": line_match}},
+                {"$pull": {"cart": line_match}, "$set": {"cart_expires_at": expires_at}}
+            )
+        except Exception as e:
+            logger.error(f"❌ Error removing cart line for user {user_id}: {str(e)}")
+            return None
+
+    async def delete_cart_reservations(self, user_ids: list, now: datetime):
+        """Delete reservations that are still due (refreshed ones are kept)"""
+        try:
+            result = await self.cart_reservations.delete_many(
+                {"user_id": {"$in": user_ids}, "expires_at": {"$lte": now}}
+            )
+            return result.deleted_count
+        except Exception as e:
+            logger.error(f"❌ Failed to delete cart reservations: {str(e)}")
+            return 0
+
+    async def backfill_cart_reservations(self):
+        """Create reservations for carts that existed before reservations were introduced"""
+        try:
+            await self.ensure_connected()
+            operations = []
+            backfilled = 0
+            users = self.iter_users(NON_EMPTY_CART_FILTER, "cart_expiry", [("user_id", 1)])
+            async for user in users:
+                expires_at = user.get('cart_expires_at')
+                if not expires_at:
+                    continue
+                if isinstance(expires_at, str):
+                    expires_at = datetime.fromisoformat(expires_at)
+                operations.append(UpdateOne(
+                    {"user_id": user['user_id']},
+                    {"$setOnInsert": {"expires_at": expires_at}},
+                    upsert=True
+                ))
+                if len(operations) >= DEFAULT_BATCH_SIZE:
+                    await self.cart_reservations.bulk_write(operations, ordered=False)
+                    backfilled += len(operations)
+                    operations = []
+            if operations:
+                await self.cart_reservations.bulk_write(operations, ordered=False)
+                backfilled += len(operations)
+            if backfilled:
+                logger.info(f"✅ Backfilled {backfilled} cart reservations")
+            return True
+        except Exception as e:
+            logger.error(f"❌ Failed to backfill cart reservations: {str(e)}")
+            return False
+
+    async def _iter_collection(self, collection: str, query=None, projection=None, sort=None,
+                               batch_size: int = DEFAULT_BATCH_SIZE):
+        """Stream documents batch by batch instead of loading the whole result with to_list"""
+        try:
+            await self.ensure_connected()
+            if self._db is None:
+                raise ConnectionError("❌ Database connection not established")
+
+            cursor = self.db[collection].find(query or {}, resolve_projection(collection, projection))
+            if sort:
+                cursor = cursor.sort(sort)
+            async for doc in cursor.batch_size(batch_size):
+                if '_id' in doc:
+                    doc['_id'] = str(doc['_id'])
+                yield doc
+        except Exception as e:
+            logger.error(f"❌ Error streaming {collection}: {str(e)}")
+            raise
+
+    def iter_users(self, query=None, projection=None, sort=None, batch_size: int = DEFAULT_BATCH_SIZE):
+        """Stream users (projection: a field dict or a view name from views.py)"""
+        return self._iter_collection("users", query, projection, sort, batch_size)
+
+    def iter_products(self, query=None, projection=None, sort=None, batch_size: int = DEFAULT_BATCH_SIZE):
+        """Stream products (projection: a field dict or a view name from views.py)"""
+        return self._iter_collection("products", query, projection, sort, batch_size)
+
+    async def iter_user_ids(self, after_user_id=None, batch_size: int = DEFAULT_BATCH_SIZE):
+        """Stream user_ids in ascending order, optionally starting after a checkpoint"""
+        query = None if after_user_id is None else {"user_id": {"$gt": after_user_id}}
+        async for user in self.iter_users(query, "broadcast", [("user_id", 1)], batch_size):
+            yield user['user_id']
+
+    async def take_rate_limit_token(self, key: str, rate: float, capacity: float):
+        """
+        Token bucket shared by all bot instances: refill by elapsed server time and take
+        one token in a single atomic pipeline update. Returns True/False, or None on failure.
+        """
+        elapsed = {"$divide": [{"$subtract": ["$$NOW", {"$ifNull": ["$updated_at", "$$NOW"]}]}, 1000]}
+        pipeline = [
+            {"$set": {
+                "tokens": {"$min": [capacity, {"$add": [
+                    {"$ifNull": ["$tokens", capacity]}, {"$multiply": [elapsed, rate]}
+                ]}]},
+                "updated_at": "$$NOW"
+            }},
+            {"$set": {"allowed": {"$gte": ["$tokens", 1]}}},
+            {"$set": {"tokens": {"$cond": ["$allowed", {"$subtract": ["$tokens", 1]}, "$tokens"]}}}
+        ]
+        try:
+            await self.ensure_connected()
+            bucket = await self.rate_limits.find_one_and_update(
+                {"_id": key}, pipeline, upsert=True, return_document=ReturnDocument.AFTER
+            )
+            return bool(bucket and bucket.get("allowed"))
+        except Exception as e:
+            logger.error(f"❌ Rate limit check failed for {key}: {str(e)}")
+            return None
+
+    async def create_broadcast(self, broadcast_data):
+        """Create a broadcast progress record"""
+        try:
+            await self.ensure_connected()
+            result = await self.broadcasts.insert_one(broadcast_data)
+            return str(result.inserted_id)
+        except Exception as e:
+            logger.error(f"❌ Failed to create broadcast: {str(e)}")
+            return None
+
+    async def get_broadcast(self, broadcast_id: str):
+        try:
+            await self.ensure_connected()
+            broadcast = await self.broadcasts.find_one({'_id': ObjectId(broadcast_id)})
+            if broadcast:
+                broadcast['_id'] = str(broadcast['_id'])
+            return broadcast
+        except Exception as e:
+            logger.error(f"❌ Failed to get broadcast '{broadcast_id}': {str(e)}")
+            return None
+
+    async def update_broadcast(self, broadcast_id: str, update_data: dict):
+        try:
+            await self.ensure_connected()
+            result = await self.broadcasts.update_one({'_id': ObjectId(broadcast_id)}, {'$set': update_data})
+            return result.modified_count > 0
+        except Exception as e:
+            logger.error(f"❌ Failed to update broadcast '{broadcast_id}': {str(e)}")
+            return False
+
+    async def get_running_broadcasts(self):
+        """Get broadcasts interrupted before completion"""
+        try:
+            await self.ensure_connected()
+            cursor = self.broadcasts.find({"status": "running"})
+            broadcasts = await cursor.to_list(length=None)
+            for broadcast in broadcasts:
+                broadcast['_id'] = str(broadcast['_id'])
+            return broadcasts
+        except Exception as e:
+            logger.error(f"❌ Failed to get running broadcasts: {str(e)}")
+            return []
+
     async def add_product(self, product_data):
         try:
             result = await self.db.products.insert_one(product_data)
+            self._product_cache.invalidate(str(result.inserted_id))
             return str(result.inserted_id)
         except Exception as e:
             logger.error(f"❌ Error adding product: {str(e)}")
@@ -170,6 +564,10 @@ class MongoDB:
 
     async def get_product(self, product_id):
         try:
+            cached = self._product_cache.get(product_id)
+            if cached is not None:
+                return cached
+
             await self.ensure_connected()
             if self._db is None:
                 raise ConnectionError("❌ Database connection not established")
@@ -180,44 +578,72 @@ class MongoDB:
                 logger.warning(f"⚠️ Invalid ObjectId format: {product_id}, error: {str(e)}")
                 return None
             
+            token = self._product_cache.token()
             product = await self.db.products.find_one({"_id": obj_id})
             if product:
                 product['_id'] = str(product['_id'])
+                self._product_cache.put(product, token)
             return product
         except Exception as e:
             logger.error(f"❌ Error getting product {product_id}: {str(e)}")
             return None
 
-    async def get_products_by_category(self, category):
-        """Get all products from a specific category"""
+    async def get_products_by_ids(self, product_ids, projection=None):
+        """
+        Get several products with a single $in query.
+        Returns a dict keyed by the string _id; unknown or invalid ids are omitted.
+        Cached products are served from memory and only the misses are queried.
+        """
+        products = {}
         try:
-            cursor = self.db.products.find({"category": category})
-            products = await cursor.to_list(length=None)
-            
-            for product in products:
-                product['_id'] = str(product['_id'])
+            missing = []
+            for product_id in dict.fromkeys(str(product_id) for product_id in product_ids):
+                cached = self._product_cache.get(product_id)
+                if cached is not None:
+                    products[product_id] = cached
+                    continue
+                try:
+                    missing.append(ObjectId(product_id))
+                except Exception as e:
+                    logger.warning(f"⚠️ Invalid ObjectId format: {product_id}, error: {str(e)}")
 
-            return products
-        except Exception as e:
-            logger.error(f"❌ Error getting products for category '{category}': {str(e)}")
-            return []
+            if not missing:
+                return products
 
-    async def get_all_products(self):
-        """Get all products from the database"""
-        try:
             await self.ensure_connected()
             if self._db is None:
                 raise ConnectionError("❌ Database connection not established")
 
-            cursor = self.db.products.find()
-            products = await cursor.to_list(length=None)
+            token = self._product_cache.token()
+            cursor = self.db.products.find({"_id": {"$in": missing}}, projection)
+            async for product in cursor:
+                product['_id'] = str(product['_id'])
+                if projection is None:
+                    self._product_cache.put(product, token)
+                products[product['_id']] = product
+            return products
+        except Exception as e:
+            logger.error(f"❌ Error getting products by ids: {str(e)}")
+            return products
+
+    async def get_products_by_category(self, category):
+        """Get all products from a specific category"""
+        try:
+            cached = self._product_cache.get_category(category)
+            if cached is not None:
+                return cached
 
+            token = self._product_cache.token()
+            cursor = self.db.products.find({"category": category})
+            products = await cursor.to_list(length=None)
+            
             for product in products:
                 product['_id'] = str(product['_id'])
 
+            self._product_cache.put_category(category, products, token)
             return products
         except Exception as e:
-            logger.error(f"❌ Error getting all products: {str(e)}")
+            logger.error(f"❌ Error getting products for category '{category}': {str(e)}")
             return []
 
     async def update_product(self, product_id, update_data):
@@ -229,60 +655,186 @@ class MongoDB:
                 
             obj_id = ObjectId(product_id)
             result = await self.db.products.update_one({"_id": obj_id}, {"$set": update_data})
+            self._product_cache.invalidate(product_id)
             return result
         except Exception as e:
             logger.error(f"❌ Error updating product '{product_id}': {str(e)}")
             return None
 
     async def update_product_flavor_quantity(self, product_id, flavor_name, quantity_change):
-        """Atomically update the quantity of a specific flavor in a product"""
+        """
+        Atomically update the quantity of a specific flavor in a product.
+        Decrements are guarded so stock never goes negative.
+        Returns the new quantity, or None if the product/flavor is missing or stock is insufficient.
+        """
         try:
             obj_id = ObjectId(product_id)
-            
-            # Use $inc to atomically increment/decrement the quantity
-            result = await self.db.products.update_one(
+
+            flavor_filter = {"name": flavor_name}
+            if quantity_change < 0:
+                # Reserve only if enough stock is left — single guarded round trip
+                flavor_filter["quantity"] = {"$gte": -quantity_change}
+
+            product = await self.db.products.find_one_and_update(
                 {
                     "_id": obj_id,
-                    "flavors.name": flavor_name
+                    "flavors": {"$elemMatch": flavor_filter}
                 },
                 {
                     "$inc": {
                         "flavors.$.quantity": quantity_change
                     }
-                }
+                },
+                projection={"flavors": {"$elemMatch": {"name": flavor_name}}},
+                return_document=ReturnDocument.AFTER
             )
-            
-            if result.modified_count > 0:
-                # Check if quantity would go below 0 and prevent it
-                product = await self.get_product(product_id)
-                if product:
-                    flavors = product.get('flavors', [])
-                    flavor = next((f for f in flavors if f.get('name') == flavor_name), None)
-                    if flavor and flavor.get('quantity', 0) < 0:
-                        # Revert the change if quantity would be negative
-                        await self.db.products.update_one(
-                            {
-                                "_id": obj_id,
-                                "flavors.name": flavor_name
-                            },
-                            {
-                                "$inc": {
-                                    "flavors.$.quantity": -quantity_change
-                                }
-                            }
-                        )
-                        return False
-                return True
-            return False
+
+            if not product or not product.get('flavors'):
+                return None
+
+            new_quantity = product['flavors'][0].get('quantity', 0)
+            self._product_cache.patch_flavor(product_id, flavor_name, quantity=new_quantity)
+            return new_quantity
         except Exception as e:
             logger.error(f"❌ Error updating flavor quantity for product '{product_id}', flavor '{flavor_name}': {str(e)}")
-            return False
+            return None
+
+    async def release_items(self, items, session=None, strict: bool = False):
+        """
+        Return items (cart lines or order items) to stock with one unordered bulk_write.
+        Quantities for the same product/flavor pair are merged into a single $inc.
+        Pass `session` to run the write inside a caller's transaction.
+        With `session` or `strict`, write errors are raised instead of reported per item,
+        so the caller can abort; products or flavors that no longer exist are still reported.
+        Returns a list of per-item results aligned with `items`:
+        {'product_id', 'flavor', 'quantity', 'success'}
+        """
+        results = []
+        totals = {}
+
+        for item in items:
+            product_id = item.get('product_id')
+            flavor = item.get('flavor')
+            quantity = item.get('quantity', 0)
+            result = {'product_id': product_id, 'flavor': flavor, 'quantity': quantity, 'success': True}
+            results.append(result)
+
+            # Items without a flavor never reserved stock
+            if not flavor or quantity <= 0:
+                continue
+            if not ObjectId.is_valid(str(product_id)):
+                logger.warning(f"⚠️ Invalid ObjectId format: {product_id}")
+                result['success'] = False
+                continue
+
+            key = (str(product_id), flavor)
+            totals[key] = totals.get(key, 0) + quantity
+
+        if not totals:
+            return results
+
+        operations = [
+            UpdateOne(
+                {"_id": ObjectId(product_id), "flavors.name": flavor},
+                {"$inc": {"flavors.$.quantity": quantity}}
+            )
+            for (product_id, flavor), quantity in totals.items()
+        ]
+
+        failed_keys = set()
+        try:
+            await self.ensure_connected()
+            try:
+                bulk_result = await self.db.products.bulk_write(operations, ordered=False, session=session)
+                matched_count = bulk_result.matched_count
+            except BulkWriteError as e:
+                logger.error(f"❌ Partial failure releasing items: {e.details.get('writeErrors')}")
+                if strict or session is not None:
+                    raise
+                matched_count = e.details.get('nMatched', 0)
+
+            if matched_count < len(operations):
+                # Some pairs did not match — find out which ones in one extra query
+                product_ids = list({ObjectId(product_id) for product_id, _ in totals})
+                cursor = self.db.products.find({"_id": {"$in": product_ids}}, {"flavors.name": 1}, session=session)
+                existing = set()
+                async for product in cursor:
+                    for flavor in product.get('flavors', []):
+                        existing.add((str(product['_id']), flavor.get('name')))
+                failed_keys = {key for key in totals if key not in existing}
+        except Exception as e:
+            logger.error(f"❌ Error releasing items to stock: {str(e)}")
+            if strict or session is not None:
+                raise
+            failed_keys = set(totals)
+
+        for (product_id, flavor), quantity in totals.items():
+            if (product_id, flavor) not in failed_keys:
+                self._product_cache.patch_flavor(product_id, flavor, delta=quantity)
+
+        for result in results:
+            if (str(result['product_id']), result['flavor']) in failed_keys:
+                result['success'] = False
+                logger.error(
+                    f"❌ Failed to release flavor quantity: product_id={result['product_id']}, flavor={result['flavor']}"
+                )
+
+        return results
+
+    async def deduct_order_stock(self, items):
+        """
+        Deduct confirmed order items from stock in one ordered bulk_write:
+        a positional $inc per product/flavor pair, followed by a conditional DeleteOne per product
+        that only matches when no flavor has stock left after the updates.
+        Nothing is read first, so concurrent reservations are never overwritten.
+        Returns {'matched', 'expected', 'deleted'} or None on failure.
+        """
+        totals = {}
+        for item in items:
+            product_id, flavor = str(item.get('product_id')), item.get('flavor')
+            if not flavor or not ObjectId.is_valid(product_id):
+                continue
+            key = (product_id, flavor)
+            totals[key] = totals.get(key, 0) + item.get('quantity', 0)
+
+        if not totals:
+            return {'matched': 0, 'expected': 0, 'deleted': 0}
+
+        product_ids = list(dict.fromkeys(product_id for product_id, _ in totals))
+        operations = [
+            UpdateOne(
+                {"_id": ObjectId(product_id), "flavors.name": flavor},
+                {"$inc": {"flavors.$.quantity": -quantity}}
+            )
+            for (product_id, flavor), quantity in totals.items()
+        ] + [
+            # Sold out: no flavor with a non-zero quantity remains
+            DeleteOne({
+                "_id": ObjectId(product_id),
+                "flavors": {"$not": {"$elemMatch": {"quantity": {"$nin": [0, None]}}}}
+            })
+            for product_id in product_ids
+        ]
+
+        try:
+            await self.ensure_connected()
+            result = await self.products.bulk_write(operations, ordered=True)
+            if result.matched_count < len(totals):
+                logger.warning(f"⚠️ Only {result.matched_count} of {len(totals)} order items matched a product flavor")
+            return {'matched': result.matched_count, 'expected': len(totals), 'deleted': result.deleted_count}
+        except Exception as e:
+            logger.error(f"❌ Error deducting order stock: {str(e)}")
+            return None
+        finally:
+            for product_id in product_ids:
+                self._product_cache.invalidate(product_id)
 
     async def delete_product(self, product_id):
         """Delete a product by its ID"""
         try:
             obj_id = ObjectId(product_id)
             result = await self.db.products.delete_one({"_id": obj_id})
+            self._product_cache.invalidate(product_id)
             return result
         except Exception as e:
             logger.error(f"❌ Error deleting product '{product_id}': {str(e)}")
@@ -295,25 +847,183 @@ class MongoDB:
                 raise ConnectionError("❌ Database connection not established")
                 
             result = await self.db.orders.insert_one(order_data)
+            if order_data.get('status') in ACTIVE_ORDER_STATUSES:
+                await self._inc_active_orders(1)
+            self._notify_write("orders", str(result.inserted_id))
             return str(result.inserted_id)
         except Exception as e:
             logger.error(f"❌ Failed to create order: {str(e)}")
             return None
 
-    async def get_all_orders(self):
+    async def checkout_order(self, order_data, idempotency_key: str, build_notification):
+        """
+        Commit a checkout as one unit: insert the order, clear the user's cart, drop the cart
+        reservation (the order now holds the stock) and enqueue the admin notification in the outbox.
+        The order's items must equal the user's current cart, otherwise nothing is committed.
+        build_notification(order_id) returns the list of Bot API calls to enqueue.
+        The idempotency key is unique, so a redelivered update returns the existing order.
+        Returns (order_id, created), or (None, False) on failure.
+        """
+        order_id = ObjectId()
+        order = dict(order_data, _id=order_id, idempotency_key=idempotency_key)
+        user_id = order['user_id']
+
+        async def commit(session=None):
+            # The order insert comes first: without a transaction it is the commit point
+            await self.orders.insert_one(order, session=session)
+            # The cart is cleared only if it still holds the ordered items: if the expiry sweeper
+            # has already taken it and returned the stock, the order must not be created
+            result = await self.users.update_one(
+                {"user_id": user_id, "cart": order.get('items', [])},
+                {"$set": {"cart": [], "cart_expires_at": None}},
+                session=session
+            )
+            if result.matched_count == 0:
+                if session is None:
+                    await self.orders.delete_one({"_id": order_id})
+                raise ValueError("cart changed or expired before checkout")
+            await self.enqueue_outbox(
+                f"order_created:{order_id}", build_notification(str(order_id)), session=session
+            )
+            await self.cart_reservations.delete_one({"user_id": user_id}, session=session)
+            if order.get('status') in ACTIVE_ORDER_STATUSES:
+                await self._inc_active_orders(1, session=session)
+
+        try:
+            await self.ensure_connected()
+            try:
+                await self._run_transaction(commit)
+            except DuplicateKeyError:
+                existing = await self.orders.find_one({"idempotency_key": idempotency_key}, {"_id": 1})
+                if existing is None:
+                    raise
+                logger.info(f"ℹ️ Checkout {idempotency_key} already committed as order {existing['_id']}")
+                return str(existing['_id']), False
+
+            self._notify_write("orders", str(order_id))
+            self._notify_write("users", user_id)
+            self._notify_write("outbox", f"order_created:{order_id}")
+            return str(order_id), True
+        except Exception as e:
+            logger.error(f"❌ Failed to commit checkout for user {user_id}: {str(e)}")
+            # The cached user document may be stale (e.g. the cart was taken by the sweeper)
+            self._notify_write("users", user_id)
+            return None, False
+
+    async def enqueue_outbox(self, key: str, calls: list, session=None):
+        """
+        Add a notification to the outbox. `calls` is a list of Bot API calls
+        ({'method', 'params'}) delivered in order; `key` deduplicates repeated enqueues.
+        Finished records are removed by the TTL index on finished_at.
+        """
+        now = datetime.now()
+        await self.outbox.update_one(
+            {"_id": key},
+            {"$setOnInsert": {
+                "calls": calls,
+                "step": 0,
+                "status": "pending",
+                "attempts": 0,
+                "next_attempt_at": now,
+                "locked_until": None,
+                "created_at": now
+            }},
+            upsert=True,
+            session=session
+        )
+        if session is None:
+            # Inside a transaction the caller notifies after commit
+            self._notify_write("outbox", key)
+
+    async def claim_outbox(self, now: datetime, lease_seconds: float):
+        """Lease the next due notification (or one whose lease expired) to this worker"""
+        try:
+            await self.ensure_connected()
+            return await self.outbox.find_one_and_update(
+                {"$or": [
+                    {"status": "pending", "next_attempt_at": {"$lte": now}},
+                    {"status": "sending", "locked_until": {"$lte": now}}
+                ]},
+                {
+                    "$set": {"status": "sending", "locked_until": now + timedelta(seconds=lease_seconds)},
+                    "$inc": {"attempts": 1}
+                },
+                sort=[("next_attempt_at", 1)],
+                return_document=ReturnDocument.AFTER
+            )
+        except Exception as e:
+            logger.error(f"❌ Failed to claim outbox record: {str(e)}")
+            return None
+
+    async def update_outbox(self, key: str, update_data: dict):
+        try:
+            await self.ensure_connected()
+            await self.outbox.update_one({"_id": key}, {"$set": update_data})
+            return True
+        except Exception as e:
+            logger.error(f"❌ Failed to update outbox record {key}: {str(e)}")
+            return False
+
+    async def get_next_outbox_attempt(self):
+        """Get the earliest next_attempt_at among pending notifications"""
+        try:
+            await self.ensure_connected()
+            record = await self.outbox.find_one(
+                {"status": "pending"}, {"next_attempt_at": 1}, sort=[("next_attempt_at", 1)]
+            )
+            return record['next_attempt_at'] if record else None
+        except Exception as e:
+            logger.error(f"❌ Failed to get next outbox attempt: {str(e)}")
+            return None
+
+    async def get_orders_page(self, query=None, cursor=None, direction: str = "older", limit: int = 1,
+                              projection=None):
+        """
+        Keyset page over orders sorted newest first by (created_at, _id).
+        cursor is the (created_at, _id) of the order the page starts from; direction "older"
+        returns orders after it in the list, "newer" the ones before it.
+        Returns (orders, has_more), where has_more tells whether the list continues in that direction.
+        """
         try:
             await self.ensure_connected()
             if self._db is None:
                 raise ConnectionError("❌ Database connection not established")
-                
-            cursor = self.db.orders.find().sort('created_at', -1)
-            orders = await cursor.to_list(length=None)
-            for order in orders:
-                order['_id'] = str(order['_id'])
-            return orders
+
+            order = -1 if direction == "older" else 1
+            op = "$lt" if direction == "older" else "$gt"
+            conditions = [query] if query else []
+            if cursor is not None:
+                created_at, order_id = cursor
+                conditions.append({"$or": [
+                    {"created_at": {op: created_at}},
+                    {"created_at": created_at, "_id": {op: ObjectId(order_id)}}
+                ]})
+            filter_ = {"$and": conditions} if len(conditions) > 1 else (conditions[0] if conditions else {})
+
+            found = self.db.orders.find(filter_, resolve_projection("orders", projection)).sort(
+                [("created_at", order), ("_id", order)]
+            ).limit(limit + 1)
+            orders = await found.to_list(length=limit + 1)
+            for item in orders:
+                item['_id'] = str(item['_id'])
+
+            has_more = len(orders) > limit
+            orders = orders[:limit]
+            if direction != "older":
+                orders.reverse()
+            return orders, has_more
         except Exception as e:
-            logger.error(f"❌ Failed to get all orders: {str(e)}")
-            return []
+            logger.error(f"❌ Failed to get orders page: {str(e)}")
+            return [], False
+
+    async def count_orders(self, query=None) -> int:
+        """Count orders matching a filter"""
+        try:
+            await self.ensure_connected()
+            return await self.orders.count_documents(query or {})
+        except Exception as e:
+            logger.error(f"❌ Failed to count orders: {str(e)}")
+            return 0
 
     async def get_order(self, order_id: str):
         try:
@@ -337,8 +1047,28 @@ class MongoDB:
                 raise ConnectionError("❌ Database connection not established")
                 
             obj_id = ObjectId(order_id)
-            result = await self.db.orders.update_one({'_id': obj_id}, {'$set': update_data})
-            return result.modified_count > 0
+            if 'status' not in update_data:
+                result = await self.db.orders.update_one({'_id': obj_id}, {'$set': update_data})
+                if result.modified_count > 0:
+                    self._notify_write("orders", order_id)
+                return result.modified_count > 0
+
+            # Status changes must keep the active orders counter in sync
+            previous = await self.db.orders.find_one_and_update(
+                {'_id': obj_id},
+                {'$set': update_data},
+                projection={'status': 1},
+                return_document=ReturnDocument.BEFORE
+            )
+            if previous is None:
+                return False
+
+            was_active = previous.get('status') in ACTIVE_ORDER_STATUSES
+            is_active = update_data['status'] in ACTIVE_ORDER_STATUSES
+            if was_active != is_active:
+                await self._inc_active_orders(1 if is_active else -1)
+            self._notify_write("orders", order_id)
+            return True
         except Exception as e:
             logger.error(f"❌ Failed to update order '{order_id}': {str(e)}")
             return False
@@ -347,8 +1077,14 @@ class MongoDB:
         try:
             await self.ensure_connected()
             obj_id = ObjectId(order_id)
-            result = await self.db.orders.delete_one({'_id': obj_id})
-            return result.deleted_count > 0
+            deleted = await self.db.orders.find_one_and_delete({'_id': obj_id}, projection={'status': 1})
+            if deleted is None:
+                return False
+
+            if deleted.get('status') in ACTIVE_ORDER_STATUSES:
+                await self._inc_active_orders(-1)
+            self._notify_write("orders", order_id)
+            return True
         except Exception as e:
             logger.error(f"❌ Failed to delete order '{order_id}': {str(e)}")
             return False
@@ -374,55 +1110,118 @@ class MongoDB:
                 {"$set": {"enabled": enabled, "end_time": end_time}},
                 upsert=True
             )
+            self._notify_write("settings", "sleep_mode")
             logger.info(f"✅ Sleep mode set: enabled={enabled}, end_time={end_time}")
         except Exception as e:
             logger.error(f"❌ Error setting sleep mode: {str(e)}")
             raise
 
+    async def _inc_active_orders(self, delta: int, session=None):
+        """Atomically adjust the active orders counter"""
+        await self.settings.update_one(
+            {"setting": "active_orders"},
+            {"$inc": {"count": delta}},
+            upsert=True,
+            session=session
+        )
+
+    async def _reseed_active_orders_counter(self) -> int:
+        """Recount active orders and store the result in the counter document"""
+        count = await self.orders.count_documents({"status": {"$in": list(ACTIVE_ORDER_STATUSES)}})
+        await self.settings.update_one(
+            {"setting": "active_orders"},
+            {"$set": {"count": count}},
+            upsert=True
+        )
+        return count
+
     async def count_approved_orders(self) -> int:
         """Count the number of active orders (pending + confirmed)"""
         try:
             await self.ensure_connected()
-            return await self.orders.count_documents({"status": {"$in": ["pending", "confirmed"]}})
+            counter = await self.settings.find_one({"setting": "active_orders"}, {"count": 1})
+            if counter is None:
+                return await self._reseed_active_orders_counter()
+            return max(0, counter.get("count", 0))
         except Exception as e:
             logger.error(f"❌ Error counting approved orders: {str(e)}")
             return 0
 
-    async def delete_all_orders(self) -> bool:
-        """Delete all orders from the database"""
+    async def purge_all_orders(self):
+        """
+        Delete every order and return the stock reserved by pending ones in a few server-side steps:
+        bound the purge by the newest order _id, sum pending quantities per (product, flavor) with an
+        aggregation, restore them with one bulk_write and remove the bounded orders with delete_many.
+        Runs in a transaction when the deployment supports it (replica set / mongos).
+        Orders created while the purge runs get a later _id and are therefore kept.
+        A failed stock write aborts the purge before any order is deleted.
+        Returns a summary dict, or None on failure.
+        """
+        async def purge(session=None):
+            # Snapshot bound on the _id index instead of marking every order with an extra write
+            newest = await self.orders.find_one({}, {"_id": 1}, sort=[("_id", -1)], session=session)
+            purge_filter = {"_id": {"$lte": newest["_id"]}} if newest else {"_id": None}
+            pipeline = [
+                {"$match": dict(purge_filter, status="pending")},
+                {"$unwind": "$items"},
+                {"$group": {
+                    "_id": {"product_id": "$items.product_id", "flavor": "$items.flavor"},
+                    "quantity": {"$sum": "$items.quantity"}
+                }}
+            ]
+            pending_orders = await self.orders.count_documents(
+                dict(purge_filter, status="pending"), session=session
+            )
+            totals = await self.orders.aggregate(pipeline, session=session).to_list(length=None)
+            results = await self.release_items([
+                {"product_id": row["_id"].get("product_id"), "flavor": row["_id"].get("flavor"), "quantity": row["quantity"]}
+                for row in totals
+            ], session=session, strict=True)
+            deleted = await self.orders.delete_many(purge_filter, session=session)
+            return {
+                "orders_deleted": deleted.deleted_count,
+                "pending_orders": pending_orders,
+                "items_restored": sum(r["quantity"] for r in results if r["success"] and r["flavor"]),
+                "positions_restored": sum(1 for r in results if r["success"] and r["flavor"]),
+                "positions_failed": sum(1 for r in results if not r["success"])
+            }
+
         try:
             await self.ensure_connected()
-            result = await self.orders.delete_many({})
-            return result.deleted_count > 0
-        except Exception as e:
-            logger.error(f"❌ Error deleting all orders: {str(e)}")
-            return False
+            summary, in_transaction = await self._run_transaction(purge)
+            summary["transaction"] = in_transaction
 
-    async def get_users_with_cart(self):
-        """Get all users who have non-empty carts"""
-        try:
-            cursor = self.db.users.find({"cart": {"$ne": []}})
-            users = await cursor.to_list(length=None)
-            for user in users:
-                user['_id'] = str(user['_id'])
-            return users
+            await self._reseed_active_orders_counter()
+            if summary["orders_deleted"]:
+                self._notify_write("orders")
+            logger.info(f"✅ Purged orders: {summary}")
+            return summary
         except Exception as e:
-            logger.error(f"❌ Failed to get users with cart: {str(e)}")
-            return []
+            logger.error(f"❌ Error purging orders: {str(e)}")
+            return None
+        finally:
+            # release_items patches the cache on every attempt, including retried or aborted ones
+            self._product_cache.clear()
 
     async def delete_user(self, user_id):
         """Удалить пользователя по user_id"""
         try:
             result = await self.db.users.delete_one({"user_id": user_id})
+            self._notify_write("users", user_id)
             return result.deleted_count > 0
         except Exception as e:
             logger.error(f"❌ Error deleting user {user_id}: {str(e)}")
             return False
 
-    async def delete_users_bulk(self, user_ids: list):
-        """Массовое удаление пользователей по списку user_id"""
+    async def delete_users_bulk(self, user_ids: list, only_empty_cart: bool = False):
+        """Массовое удаление пользователей по списку user_id (опционально — только с пустой корзиной)"""
         try:
-            result = await self.db.users.delete_many({"user_id": {"$in": user_ids}})
+            query = {"user_id": {"$in": user_ids}}
+            if only_empty_cart:
+                query["cart.0"] = {"$exists": False}
+            result = await self.db.users.delete_many(query)
+            for user_id in user_ids:
+                self._notify_write("users", user_id)
             logger.info(f"Bulk deleted {result.deleted_count} users: {user_ids}")
             return result.deleted_count
         except Exception as e:
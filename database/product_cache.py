@@ -0,0 +1,106 @@
+import copy
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+# Products kept in memory; the least recently used ones are evicted first
+PRODUCT_CACHE_MAX_PRODUCTS = 5000
+
+
+class ProductCache:
+    """
+    Read-through cache of products keyed by _id and by category.
+    Admin writes bump the catalog version, which invalidates every cached category list;
+    stock changes from atomic updates are patched into cached products in place.
+    Entries expire after `ttl` seconds so other workers' writes become visible.
+    Callers always get deep copies, so mutating a returned product never touches the cache.
+    Readers take a token() before querying and pass it to put/put_category: if any write
+    happened while the query was in flight, its possibly stale result is not cached.
+    """
+
+    def __init__(self, ttl: float = 60, max_products: int = PRODUCT_CACHE_MAX_PRODUCTS):
+        self._ttl = ttl
+        self._max_products = max_products
+        self._version = 0
+        self._writes = 0
+        self._products: "OrderedDict[str, tuple]" = OrderedDict()  # {product_id: (cached_at, product)}
+        self._categories: Dict[str, tuple] = {}  # {category: (cached_at, version, [product_id])}
+
+    @property
+    def version(self) -> int:
+        return self._version
+
+    def token(self) -> int:
+        """Write counter to take before a read query (see put/put_category)"""
+        return self._writes
+
+    def _fresh(self, cached_at: float) -> bool:
+        return time.monotonic() - cached_at < self._ttl
+
+    def get(self, product_id: str) -> Optional[dict]:
+        entry = self._products.get(str(product_id))
+        if entry is None or not self._fresh(entry[0]):
+            return None
+        self._products.move_to_end(str(product_id))
+        return copy.deepcopy(entry[1])
+
+    def put(self, product: dict, token: Optional[int] = None):
+        """Cache a product read from the database; skipped if a write happened since token"""
+        if token is not None and token != self._writes:
+            return
+        product_id = str(product['_id'])
+        self._products[product_id] = (time.monotonic(), copy.deepcopy(product))
+        self._products.move_to_end(product_id)
+        while len(self._products) > self._max_products:
+            self._products.popitem(last=False)
+
+    def get_category(self, category: str) -> Optional[List[dict]]:
+        entry = self._categories.get(category)
+        if entry is None or entry[1] != self._version or not self._fresh(entry[0]):
+            return None
+
+        products = []
+        for product_id in entry[2]:
+            product = self.get(product_id)
+            if product is None:
+                return None
+            products.append(product)
+        return products
+
+    def put_category(self, category: str, products: List[dict], token: Optional[int] = None):
+        if token is not None and token != self._writes:
+            return
+        for product in products:
+            self.put(product)
+        self._categories[category] = (
+            time.monotonic(),
+            self._version,
+            [str(product['_id']) for product in products]
+        )
+
+    def invalidate(self, product_id: Optional[str] = None):
+        """Drop a product (or everything) and invalidate all category lists"""
+        self._version += 1
+        self._writes += 1
+        if product_id is None:
+            self._products.clear()
+        else:
+            self._products.pop(str(product_id), None)
+
+    def patch_flavor(self, product_id: str, flavor_name: str, quantity: Optional[int] = None, delta: int = 0):
+        """Apply a stock change reported by an atomic update to the cached product"""
+        self._writes += 1
+        entry = self._products.get(str(product_id))
+        if entry is None:
+            return
+
+        for flavor in entry[1].get('flavors', []):
+            if flavor.get('name') == flavor_name:
+                flavor['quantity'] = quantity if quantity is not None else flavor.get('quantity', 0) + delta
+                return
+
+    def clear(self):
+        self._products.clear()
+        self._categories.clear()
+        self._version += 1
+        self._writes += 1
@@ -0,0 +1,29 @@
+from typing import Optional, Union
+
+# Named projections ("views") per collection. Call sites ask for a view by name,
+# so list screens only decode the fields they actually render.
+VIEWS = {
+    "products": {
+        # list_products
+        "list": {"name": 1, "price": 1, "description": 1},
+        # Product pickers for edit/delete
+        "picker": {"name": 1, "price": 1},
+        # Flavor management picker shows the number of flavors
+        "flavor_counts": {"name": 1, "flavors.name": 1},
+    },
+    "users": {
+        "broadcast": {"user_id": 1, "_id": 0},
+        # Cart reservation backfill
+        "cart_expiry": {"user_id": 1, "cart_expires_at": 1},
+    },
+}
+
+
+def resolve_projection(collection: str, projection: Optional[Union[str, dict]]) -> Optional[dict]:
+    """Turn a view name into its projection; dicts and None pass through unchanged"""
+    if projection is None or isinstance(projection, dict):
+        return projection
+    try:
+        return VIEWS[collection][projection]
+    except KeyError:
+        raise ValueError(f"Unknown {collection} view: {projection}")
@@ -3,8 +3,8 @@ from aiogram.filters import Command
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.types import Message, CallbackQuery, InlineKeyboardButton, InlineKeyboardMarkup
+from aiogram.exceptions import TelegramBadRequest
 from datetime import datetime, timedelta
-import asyncio
 import logging
 
 from config import ADMIN_ID, ADMIN_SWITCHING, ORDER_STATUSES
@@ -14,18 +14,26 @@ from keyboards.admin_kb import (
     product_management_kb,
     categories_kb,
     order_management_kb,
+    orders_dashboard_kb,
+    ORDER_STATUS_FILTERS,
+    ORDER_PERIOD_FILTERS,
     sleep_mode_kb,
     product_edit_kb,  # добавлен импорт
     build_flavor_editor  # импорт функции для управления вкусами
 )
 from keyboards.user_kb import main_menu
 from utils.security import security_manager, check_admin_session, return_items_to_inventory
-from utils.message_utils import safe_delete_message
+from utils.message_utils import safe_delete_messages
+from utils.broadcast import broadcast_manager
+from utils.outbox import bot_call, queue_notification
 
 router = Router()
 
 logger = logging.getLogger(__name__)
 
+ORDERS_EPOCH = datetime(1970, 1, 1)  # Точка отсчёта курсора панели заказов
+ORDERS_VIEW_KEY = "orders_view"  # Ключ текущей страницы панели заказов в FSM-данных
+
 class AdminStates(StatesGroup):
     waiting_password = State()
     adding_product = State()
@@ -136,9 +144,18 @@ async def back_to_product_management(callback: CallbackQuery):
 @router.callback_query(F.data == "list_products")#Обработка кнопки список товаров
 @check_admin_session
 async def list_products(callback: CallbackQuery):
-    products = await db.get_all_products()
+    try:
+        # Строки собираются по мере чтения курсора, список документов целиком не загружается
+        lines = [
+            f"📦 {p['name']}\n💰 {p['price']} ₸\n📝 {p['description']}"
+            async for p in db.iter_products(projection="list")
+        ]
+    except Exception as e:
+        logger.error(f"Ошибка в list_products: {e}")
+        await callback.answer("Произошла ошибка")
+        return
 
-    if not products:
+    if not lines:
         await callback.message.edit_text(
             "📭 Товары отсутствуют.",
             reply_markup=product_management_kb()
@@ -146,10 +163,6 @@ async def list_products(callback: CallbackQuery):
         await callback.answer()
         return
 
-    lines = [
-        f"📦 {p['name']}\n💰 {p['price']} ₸\n📝 {p['description']}"
-        for p in products
-    ]
     text = "📋 Список товаров:\n\n" + "\n\n".join(lines)
 
     await callback.message.edit_text(
@@ -179,9 +192,28 @@ async def add_product_start(callback: CallbackQuery, state: FSMContext):
 @router.callback_query(F.data == "edit_products")#Обработка кнопки редактировать
 @check_admin_session
 async def edit_products_list(callback: CallbackQuery):
-    products = await db.get_all_products()
+    text_lines = ["🛠 Выберите товар для редактирования:\n"]
+    keyboard = []
+
+    try:
+        async for product in db.iter_products(projection="picker"):
+            name = product.get("name", "Без названия")
+            price = product.get("price", "—")
+            product_id = str(product.get("_id"))
+
+            text_lines.append(f"📦 {name} — {price} ₸")
+            keyboard.append([
+                InlineKeyboardButton(
+                    text=f"✏️ {name}",
+                    callback_data=f"edit_product_{product_id}"
+                )
+            ])
+    except Exception as e:
+        logger.error(f"Ошибка в edit_products_list: {e}")
+        await callback.answer("Произошла ошибка")
+        return
 
-    if not products:
+    if not keyboard:
         await callback.message.edit_text(
             "📭 Товары отсутствуют.",
             reply_markup=product_management_kb()
@@ -189,22 +221,6 @@ async def edit_products_list(callback: CallbackQuery):
         await callback.answer()
         return
 
-    text_lines = ["🛠 Выберите товар для редактирования:\n"]
-    keyboard = []
-
-    for product in products:
-        name = product.get("name", "Без названия")
-        price = product.get("price", "—")
-        product_id = str(product.get("_id"))
-
-        text_lines.append(f"📦 {name} — {price} ₸")
-        keyboard.append([
-            InlineKeyboardButton(
-                text=f"✏️ {name}",
-                callback_data=f"edit_product_{product_id}"
-            )
-        ])
-
     keyboard.append([
         InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_product_management")
     ])
@@ -218,9 +234,26 @@ async def edit_products_list(callback: CallbackQuery):
 @router.callback_query(F.data == "delete_product")#Потверждения продукта
 @check_admin_session
 async def delete_product_list(callback: CallbackQuery):
-    products = await db.get_all_products()
+    text_lines = ["🗑 Выберите товар для удаления:"]
+    keyboard = []
+
+    try:
+        async for product in db.iter_products(projection="picker"):
+            name = product.get("name", "Без названия")
+
+            text_lines.append(f"📦 {name} — {product.get('price', '—')} ₸")
+            keyboard.append([
+                InlineKeyboardButton(
+                    text=f"❌ {name}",
+                    callback_data=f"confirm_delete_{str(product.get('_id'))}"
+                )
+            ])
+    except Exception as e:
+        logger.error(f"Ошибка в delete_product_list: {e}")
+        await callback.answer("Произошла ошибка")
+        return
 
-    if not products:
+    if not keyboard:
         await callback.message.edit_text(
             "📭 Товары отсутствуют.",
             reply_markup=product_management_kb()
@@ -228,25 +261,12 @@ async def delete_product_list(callback: CallbackQuery):
         await callback.answer()
         return
 
-    keyboard = [
-        [InlineKeyboardButton(
-            text=f"❌ {product.get('name', 'Без названия')}",
-            callback_data=f"confirm_delete_{str(product.get('_id'))}"
-        )]
-        for product in products
-    ]
-
     keyboard.append([
         InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_product_management")
     ])
 
-    text = "\n".join([
-        "🗑 Выберите товар для удаления:",
-        *(f"📦 {p.get('name', 'Без названия')} — {p.get('price', '—')} ₸" for p in products)
-    ])
-
     await callback.message.edit_text(
-        text,
+        "\n".join(text_lines),
         reply_markup=InlineKeyboardMarkup(inline_keyboard=keyboard)
     )
     await callback.answer()
@@ -571,66 +591,168 @@ async def process_edit_photo(message: Message, state: FSMContext):
         await message.answer("❌ Произошла ошибка при обновлении фото.")
         await state.clear()
 
-@router.message(F.text == "📊 Заказы")#Обработка кнопки заказы
-@check_admin_session
-async def show_orders(message: Message, state: FSMContext):
-    try:
-        await db.ensure_connected()
-        orders = await db.get_all_orders()
+def _encode_order_cursor(order: dict) -> str:
+    """Курсор панели заказов: created_at в миллисекундах и _id"""
+    created_at = order.get("created_at") or ORDERS_EPOCH
+    return f"{(created_at - ORDERS_EPOCH) // timedelta(milliseconds=1)}_{order['_id']}"
+
+def _decode_order_cursor(millis: str, order_id: str) -> tuple:
+    return ORDERS_EPOCH + timedelta(milliseconds=int(millis)), order_id
+
+def _orders_filter_query(status_filter: str, period_filter: str) -> dict:
+    query = {}
+    status = ORDER_STATUS_FILTERS.get(status_filter, ("", None))[1]
+    if status:
+        query["status"] = status
+    days = ORDER_PERIOD_FILTERS.get(period_filter, ("", None))[1]
+    if days is not None:
+        since = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=days)
+        query["created_at"] = {"$gte": since}
+    return query
+
+async def render_orders_dashboard(status_filter: str = "a", period_filter: str = "a",
+                                  cursor: tuple = None, direction: str = "older"):
+    """Формирует одну страницу панели заказов. Возвращает (текст, клавиатура, число активных заказов)"""
+    query = _orders_filter_query(status_filter, period_filter)
+    orders, has_more = await db.get_orders_page(query, cursor, direction)
+    if not orders and cursor is not None:
+        # Заказ, от которого листали, мог быть удалён — начинаем с первой страницы
+        cursor, direction = None, "older"
+        orders, has_more = await db.get_orders_page(query)
+
+    total = await db.count_orders(query)
+    active_count = await db.count_approved_orders()
+
+    status_label = ORDER_STATUS_FILTERS.get(status_filter, ("Все", None))[0]
+    period_label = ORDER_PERIOD_FILTERS.get(period_filter, ("Всё время", None))[0]
+    header = f"📋 Заказы: {status_label} · {period_label}\nНайдено: {total}\n\n"
+    stats = (
+        f"\n\n📊 Статистика заказов:\n"
+        f"📦 Заказов: {active_count}/{ADMIN_SWITCHING}\n"
+        f"⚠️ Магазин уйдёт в режим сна при достижении {ADMIN_SWITCHING} активных заказов"
+    )
 
-        if not orders:
-            await message.answer("📭 Нет активных заказов.")
-            return
+    if not orders:
+        keyboard = orders_dashboard_kb(status_filter=status_filter, period_filter=period_filter)
+        return header + "📭 Нет заказов по выбранному фильтру." + stats, keyboard, active_count
 
-        # Подсчёт активных заказов
-        active_orders = [o for o in orders if o.get("status") in ["pending", "confirmed"]]
-        active_count = len(active_orders)
+    order = orders[0]
+    if direction == "older":
+        has_older, has_newer = has_more, cursor is not None
+    else:
+        has_older, has_newer = True, has_more
+
+    order_id = str(order["_id"])
+    user_data = {
+        "full_name": order.get("username", "Не указано"),
+        "username": order.get("username", "Не указано"),
+    }
+    order_text = format_order_notification(
+        order_id,
+        user_data,
+        order,
+        order.get("items", []),
+        order.get("total_amount", 0)
+    )
+    status = order.get("status", "pending")
+    order_text += f"\n\nСтатус: {ORDER_STATUSES.get(status, 'Статус неизвестен')}"
+
+    keyboard = orders_dashboard_kb(
+        order_id, status, status_filter, period_filter,
+        cursor=_encode_order_cursor(order),
+        has_newer=has_newer,
+        has_older=has_older
+    )
+    return header + order_text + stats, keyboard, active_count
 
-        # Клавиатура управления
-        keyboard = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="🗑 Очистить заказы", callback_data="delete_all_orders")]
-        ])
+async def _edit_orders_dashboard(callback: CallbackQuery, text: str, keyboard: InlineKeyboardMarkup):
+    try:
+        await callback.message.edit_text(text, parse_mode="HTML", reply_markup=keyboard)
+    except TelegramBadRequest as e:
+        if "message is not modified" not in str(e):
+            raise
+
+async def _save_orders_view(state: FSMContext, message_id: int, status_filter: str = "a",
+                            period_filter: str = "a", cursor: list = None, direction: str = "older"):
+    """Запоминает текущую страницу панели заказов (фильтры и курсор), чтобы перерисовать её после действий"""
+    await state.update_data({ORDERS_VIEW_KEY: {
+        "message_id": message_id,
+        "status_filter": status_filter,
+        "period_filter": period_filter,
+        "cursor": cursor,
+        "direction": direction
+    }})
+
+def _is_orders_dashboard(message: Message) -> bool:
+    """Панель заказов узнаётся по строке фильтров в клавиатуре (уведомления о заказах её не имеют)"""
+    markup = message.reply_markup
+    return bool(markup) and any(
+        (button.callback_data or "").startswith("orders_view_")
+        for row in markup.inline_keyboard for button in row
+    )
 
-        sent_message_ids = []
-        # Отображение каждого заказа
-        for order in orders:
-            order_id = str(order.get("_id", ""))
-            user_data = {
-                "full_name": order.get("username", "Не указано"),
-                "username": order.get("username", "Не указано"),
-            }
+async def _refresh_orders_dashboard(bot, chat_id, message_id: int, state: FSMContext):
+    """Перерисовывает текущую страницу панели заказов (без сохранённого вида — первую страницу)"""
+    view = (await state.get_data()).get(ORDERS_VIEW_KEY) or {}
+    if view.get("message_id") != message_id:
+        view = {}
+    cursor = view.get("cursor")
+    status_filter = view.get("status_filter", "a")
+    period_filter = view.get("period_filter", "a")
+    text, keyboard, _ = await render_orders_dashboard(
+        status_filter,
+        period_filter,
+        cursor=_decode_order_cursor(*cursor) if cursor else None,
+        direction=view.get("direction", "older")
+    )
+    try:
+        await bot.edit_message_text(
+            text, chat_id=chat_id, message_id=message_id, parse_mode="HTML", reply_markup=keyboard
+        )
+    except TelegramBadRequest as e:
+        if "message is not modified" not in str(e):
+            raise
+    await _save_orders_view(state, message_id, status_filter, period_filter, cursor, view.get("direction", "older"))
 
-            order_text = format_order_notification(
-                order_id,
-                user_data,
-                order,
-                order.get("items", []),
-                order.get("total_amount", 0)
-            )
+async def _show_order_result(bot, chat_id, message_id: int, state: FSMContext, dashboard: bool,
+                             order_id: str, status: str = None):
+    """
+    После действия с заказом: панель заказов перерисовывается на текущей странице,
+    у уведомления о заказе обновляются кнопки (status=None — заказ удалён, кнопок нет)
+    """
+    if dashboard:
+        await _refresh_orders_dashboard(bot, chat_id, message_id, state)
+        return
+    try:
+        await bot.edit_message_reply_markup(
+            chat_id=chat_id,
+            message_id=message_id,
+            reply_markup=order_management_kb(order_id, status) if status else None
+        )
+    except TelegramBadRequest as e:
+        if "message is not modified" not in str(e):
+            logger.warning(f"Не удалось обновить кнопки заказа {order_id}: {e}")
 
-            status = order.get("status", "pending")
-            status_text = ORDER_STATUSES.get(status, "Статус неизвестен")
+async def _clear_keeping_orders_view(state: FSMContext):
+    """Сбрасывает состояние, сохраняя вид панели заказов"""
+    view = (await state.get_data()).get(ORDERS_VIEW_KEY)
+    await state.clear()
+    if view:
+        await state.update_data({ORDERS_VIEW_KEY: view})
 
-            order_text += f"\n\nСтатус: {status_text}"
+@router.message(F.text == "📊 Заказы")#Обработка кнопки заказы
+@check_admin_session
+async def show_orders(message: Message, state: FSMContext):
+    try:
+        await db.ensure_connected()
 
-            msg = await message.answer(
-                order_text,
-                parse_mode="HTML",
-                reply_markup=order_management_kb(order_id, status)
-            )
-            sent_message_ids.append(msg.message_id)
-
-        # После всех заказов — статистика и кнопки
-        stat_msg = await message.answer(
-            f"📊 Статистика заказов:\n"
-            f"📦 Заказов: {active_count}/{ADMIN_SWITCHING}\n"
-            f"⚠️ Магазин уйдёт в режим сна при достижении {ADMIN_SWITCHING} активных заказов\n",
-            reply_markup=keyboard
-        )
-        sent_message_ids.append(stat_msg.message_id)
+        # Одно сообщение с листанием вместо отдельного сообщения на каждый заказ
+        text, keyboard, active_count = await render_orders_dashboard()
+        msg = await message.answer(text, parse_mode="HTML", reply_markup=keyboard)
 
-        # Сохраняем id сообщений в state
-        await state.update_data(order_message_ids=sent_message_ids)
+        # Сохраняем id сообщения в state
+        await state.update_data(order_message_ids=[msg.message_id])
+        await _save_orders_view(state, msg.message_id)
 
         # Автопереход в спящий режим
         if active_count >= ADMIN_SWITCHING:
@@ -645,49 +767,69 @@ async def show_orders(message: Message, state: FSMContext):
         logger.error(f"Ошибка при отображении заказов: {e}")
         await message.answer("❌ Произошла ошибка при получении заказов.")
 
+@router.callback_query(F.data.startswith("orders_view_"))#Смена фильтра панели заказов
+@check_admin_session
+async def filter_orders(callback: CallbackQuery, state: FSMContext):
+    try:
+        _, _, status_filter, period_filter = callback.data.split("_")
+        text, keyboard, _ = await render_orders_dashboard(status_filter, period_filter)
+        await _edit_orders_dashboard(callback, text, keyboard)
+        await _save_orders_view(state, callback.message.message_id, status_filter, period_filter)
+        await callback.answer()
+    except Exception as e:
+        logger.error(f"Ошибка при фильтрации заказов: {e}")
+        await callback.answer("❌ Произошла ошибка при получении заказов.")
+
+@router.callback_query(F.data.startswith("orders_page_"))#Листание панели заказов
+@check_admin_session
+async def page_orders(callback: CallbackQuery, state: FSMContext):
+    try:
+        _, _, status_filter, period_filter, direction, millis, order_id = callback.data.split("_")
+        direction = "older" if direction == "n" else "newer"
+        text, keyboard, _ = await render_orders_dashboard(
+            status_filter,
+            period_filter,
+            cursor=_decode_order_cursor(millis, order_id),
+            direction=direction
+        )
+        await _edit_orders_dashboard(callback, text, keyboard)
+        await _save_orders_view(
+            state, callback.message.message_id, status_filter, period_filter, [millis, order_id], direction
+        )
+        await callback.answer()
+    except Exception as e:
+        logger.error(f"Ошибка при листании заказов: {e}")
+        await callback.answer("❌ Произошла ошибка при получении заказов.")
+
 @router.callback_query(F.data == "delete_all_orders")#Обработка кнопки удалить все заказы
 @check_admin_session
 async def delete_all_orders(callback: CallbackQuery, state: FSMContext):
     try:
-        orders = await db.get_all_orders()
+        # Возврат на склад и удаление выполняются на стороне базы несколькими пакетными операциями
+        summary = await db.purge_all_orders()
+        if summary is None:
+            await callback.answer("❌ Произошла ошибка при удалении заказов.")
+            return
 
-        if not orders:
+        if not summary["orders_deleted"]:
             await callback.answer("❗ Нет заказов для удаления.")
             return
 
-        for order in orders:
-            order_id = str(order.get("_id"))
-            status = order.get("status")
-            items = order.get("items", [])
-
-            if status == "pending":
-                for item in items:
-                    product_id = item.get("product_id")
-                    flavor = item.get("flavor")
-                    quantity = item.get("quantity", 0)
-
-                    if product_id and flavor:
-                        try:
-                            await db.update_product_flavor_quantity(product_id, flavor, quantity)
-                        except Exception as e:
-                            logger.exception(f"Ошибка при возврате на склад: {e}")
-
-            try:
-                await db.delete_order(order_id)
-            except Exception as e:
-                logger.exception(f"Ошибка при удалении заказа {order_id}: {e}")
+        if summary["positions_failed"]:
+            logger.error(f"Не удалось вернуть на склад {summary['positions_failed']} позиций")
 
         # Удаляем все сообщения с заказами и статистикой
         data = await state.get_data()
-        order_message_ids = data.get("order_message_ids", [])
-        for msg_id in order_message_ids:
-            try:
-                await callback.bot.delete_message(callback.message.chat.id, msg_id)
-            except Exception as e:
-                logger.exception(f"Ошибка при удалении сообщения заказа: {e}")
-
-        # Ответ админу (короткое подтверждение)
-        await callback.message.answer("✅ Все заказы и сообщения удалены.")
+        await safe_delete_messages(callback.bot, callback.message.chat.id, data.get("order_message_ids", []))
+
+        # Ответ админу — итог одной операции
+        await callback.message.answer(
+            f"✅ Все заказы и сообщения удалены.\n\n"
+            f"🗑 Удалено заказов: {summary['orders_deleted']}\n"
+            f"⏳ Из них ожидающих: {summary['pending_orders']}\n"
+            f"📦 Возвращено на склад: {summary['items_restored']} шт. ({summary['positions_restored']} позиций)"
+            + (f"\n❌ Не удалось вернуть позиций: {summary['positions_failed']}" if summary['positions_failed'] else "")
+        )
         await state.clear()
         await callback.answer()
 
@@ -750,8 +892,6 @@ async def prepare_broadcast(message: Message, state: FSMContext):
 
     await state.set_state(AdminStates.confirm_broadcast)
 
-SEND_DELAY = 0.05
-
 @router.callback_query(F.data == "confirm_broadcast")
 @check_admin_session
 async def handle_confirm_broadcast(callback: CallbackQuery, state: FSMContext):
@@ -763,59 +903,23 @@ async def handle_confirm_broadcast(callback: CallbackQuery, state: FSMContext):
         await state.clear()
         return
 
-    users = await db.get_all_users()
-    if not users:
-        await callback.message.edit_text("⚠️ Пользователи не найдены.")
-        await state.clear()
-        return
-
-    sent_count = 0
-    failed_count = 0
-    users_to_delete = []
-
-    for user in users:
-        try:
-            await callback.bot.send_message(
-                chat_id=user['user_id'],
-                text=broadcast_text
-            )
-            sent_count += 1
-            await asyncio.sleep(SEND_DELAY)
-        except Exception as e:
-            error_text = str(e).lower()
-            logger.error(f"Не удалось отправить сообщение пользователю {user['user_id']}: {e}")
-            failed_count += 1
-            if 'chat not found' in error_text or 'bot was blocked by the user' in error_text:
-                try:
-                    user_data = await db.get_user(user['user_id'])
-                    cart = user_data.get('cart', []) if user_data else []
-                    if not cart:
-                        users_to_delete.append(user['user_id'])
-                    else:
-                        logger.info(f"Пользователь {user['user_id']} не удалён: корзина не пуста.")
-                except Exception as del_e:
-                    logger.error(f"Ошибка при проверке пользователя {user['user_id']}: {del_e}")
-            continue
-
-    # Массовое удаление пользователей после рассылки
-    if users_to_delete:
-        try:
-            deleted_count = await db.delete_users_bulk(users_to_delete)
-            logger.info(f"Массово удалено пользователей: {deleted_count}")
-        except Exception as e:
-            logger.error(f"Ошибка при массовом удалении пользователей: {e}")
-
-    summary = (
-        f"✅ Рассылка завершена!\n\n"
-        f"📨 Отправлено: {sent_count}\n"
-        f"{'❌ Не доставлено: ' + str(failed_count) if failed_count else ''}"
+    await state.clear()
+    await callback.message.edit_text("📢 Рассылка запущена...")
+
+    # Рассылка идёт в фоне, прогресс обновляется в этом же сообщении
+    broadcast_id = await broadcast_manager.start(
+        callback.bot,
+        broadcast_text,
+        chat_id=callback.message.chat.id,
+        message_id=callback.message.message_id
     )
+    if not broadcast_id:
+        await callback.message.edit_text("❌ Не удалось запустить рассылку.")
 
-    await callback.message.edit_text(summary)
     await callback.message.answer("Главное меню", reply_markup=admin_main_menu())
     await callback.answer()
 
-    logger.info(f"Рассылка завершена: отправлено {sent_count}, не доставлено {failed_count}")
+    logger.info(f"Рассылка {broadcast_id} запущена администратором {callback.from_user.id}")
 
 
 @router.callback_query(F.data == "cancel_broadcast")#Обработка кнопки отмены рассылки
@@ -1173,18 +1277,16 @@ async def start_add_flavor(callback: CallbackQuery, state: FSMContext):
 @check_admin_session
 async def show_products_for_flavors(callback: CallbackQuery):
     try:
-        products = await db.get_all_products()
-
-        if not products:
-            return await callback.answer("Нет доступных товаров")
-
         keyboard = [
             [InlineKeyboardButton(
                 text=f"{product['name']} ({len(product.get('flavors', []))} вкусов)",
                 callback_data=f"manage_flavors_{product['_id']}"
-            )] for product in products
+            )] async for product in db.iter_products(projection="flavor_counts")
         ]
 
+        if not keyboard:
+            return await callback.answer("Нет доступных товаров")
+
         keyboard.append([
             InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_product_management")
         ])
@@ -1430,7 +1532,7 @@ def format_order_notification(order_id: str, user_data: dict, order_data: dict,
 
 @router.callback_query(F.data.startswith("admin_confirm_"))#обработка кнопки потвержждения
 @check_admin_session
-async def admin_confirm_order(callback: CallbackQuery):
+async def admin_confirm_order(callback: CallbackQuery, state: FSMContext):
     order_id = callback.data.replace("admin_confirm_", "")
 
     try:
@@ -1441,35 +1543,12 @@ async def admin_confirm_order(callback: CallbackQuery):
         if order.get('status') == 'cancelled':
             return await callback.answer("Нельзя подтвердить отмененный заказ", show_alert=True)
 
-        products_to_check = set()
-
-        for item in order['items']:
-            try:
-                product = await db.get_product(item['product_id'])
-                if not product:
-                    continue
-
-                flavors = product.get('flavors', [])
-                flavor = next((f for f in flavors if f.get('name') == item.get('flavor')), None)
-                if not flavor:
-                    continue
-
-                flavor['quantity'] -= item['quantity']
-                await db.update_product(item['product_id'], {'flavors': flavors})
-                products_to_check.add(item['product_id'])
-            except Exception as e:
-                logger.error(f"Ошибка при обновлении количества вкуса: {e}")
-                return await callback.answer("Ошибка при обновлении количества товара", show_alert=True)
-
-        for product_id in products_to_check:
-            try:
-                product = await db.get_product(product_id)
-                if product:
-                    flavors = product.get('flavors', [])
-                    if all(f.get('quantity', 0) == 0 for f in flavors):
-                        await db.delete_product(product_id)
-            except Exception as e:
-                logger.error(f"Ошибка при удалении товара без остатков: {e}")
+        # Списание одним bulk_write; распроданные товары удаляются по результату тех же операций
+        stock_result = await db.deduct_order_stock(order['items'])
+        if stock_result is None:
+            return await callback.answer("Ошибка при обновлении количества товара", show_alert=True)
+        if stock_result['deleted']:
+            logger.info(f"Удалено товаров без остатков: {stock_result['deleted']}")
 
         try:
             await db.update_order(order_id, {'status': 'confirmed'})
@@ -1483,12 +1562,16 @@ async def admin_confirm_order(callback: CallbackQuery):
                 "Спасибо за ваш заказ! ❤️"
             )
 
-            try:
-                await callback.bot.send_message(chat_id=order['user_id'], text=user_notification)
-            except Exception as e:
-                logger.warning(f"Не удалось уведомить пользователя: {e}")
+            # Уведомление клиента доставляется в фоне через outbox
+            await queue_notification(
+                f"order_confirmed:{order_id}",
+                bot_call('send_message', chat_id=order['user_id'], text=user_notification)
+            )
 
-            await safe_delete_message(callback.message)
+            await _show_order_result(
+                callback.bot, callback.message.chat.id, callback.message.message_id, state,
+                _is_orders_dashboard(callback.message), order_id, 'confirmed'
+            )
 
             await callback.message.answer(f"✅ Заказ #{order_id} подтвержден, передайте заказ курьеру в течение часа")
             await callback.answer("Заказ подтвержден")
@@ -1502,7 +1585,7 @@ async def admin_confirm_order(callback: CallbackQuery):
 
 @router.callback_query(F.data.startswith("delete_order_"))#обработка кнопки удалить заказ
 @check_admin_session
-async def delete_order(callback: CallbackQuery):
+async def delete_order(callback: CallbackQuery, state: FSMContext):
     try:
         order_id = callback.data.replace("delete_order_", "")
         order = await db.get_order(order_id)
@@ -1520,19 +1603,16 @@ async def delete_order(callback: CallbackQuery):
             logger.error(f"Не удалось удалить заказ {order_id}")
             return await callback.answer("Ошибка при удалении заказа")
 
-        try:
-            await callback.bot.send_message(
-                chat_id=order['user_id'],
-                text="❌ Ваш заказ был отменен администратором."
-            )
-        except Exception as e:
-            logger.warning(f"Ошибка при уведомлении пользователя {order['user_id']}: {e}")
+        await queue_notification(
+            f"order_deleted:{order_id}",
+            bot_call('send_message', chat_id=order['user_id'], text="❌ Ваш заказ был отменен администратором.")
+        )
 
-        await callback.message.edit_text(
-            "✅ Заказ успешно отменен\nВсе товары возвращены на склад",
-            reply_markup=order_management_kb()
+        await _show_order_result(
+            callback.bot, callback.message.chat.id, callback.message.message_id, state,
+            _is_orders_dashboard(callback.message), order_id
         )
-        await callback.answer("Заказ отменен")
+        await callback.answer("✅ Заказ успешно отменен\nВсе товары возвращены на склад", show_alert=True)
 
         logger.info(f"Заказ {order_id} успешно отменен и товары возвращены на склад")
 
@@ -1556,7 +1636,8 @@ async def admin_cancel_order(callback: CallbackQuery, state: FSMContext):
         await state.update_data({
             'order_id': order_id,
             'message_id': callback.message.message_id,
-            'chat_id': callback.message.chat.id
+            'chat_id': callback.message.chat.id,
+            'from_dashboard': _is_orders_dashboard(callback.message)
         })
 
         # Проверяем, есть ли текст в сообщении
@@ -1592,6 +1673,13 @@ async def admin_cancel_order(callback: CallbackQuery, state: FSMContext):
 async def back_to_order_from_cancel(callback: CallbackQuery, state: FSMContext):
     try:
         order_id = callback.data.replace("back_to_order_", "")
+        data = await state.get_data()
+        if data.get('from_dashboard') and data.get('message_id') == callback.message.message_id:
+            # Запрос причины показан вместо панели заказов — возвращаем её текущую страницу
+            await _refresh_orders_dashboard(callback.bot, callback.message.chat.id, callback.message.message_id, state)
+            await _clear_keeping_orders_view(state)
+            return await callback.answer("Отмена отмены заказа")
+
         order = await db.get_order(order_id)
 
         if not order:
@@ -1627,7 +1715,7 @@ async def back_to_order_from_cancel(callback: CallbackQuery, state: FSMContext):
                 reply_markup=order_management_kb(str(order["_id"]), order.get('status', 'pending'))
             )
 
-        await state.clear()
+        await _clear_keeping_orders_view(state)
         await callback.answer("Отмена отмены заказа")
 
     except Exception:
@@ -1672,19 +1760,18 @@ async def admin_finish_cancel_order(message: Message, state: FSMContext):
             f"📄 Причина: _{message.text}_\n\n"
         )
 
-        try:
-            await message.bot.send_message(
-                chat_id=order['user_id'],
-                text=user_notification,
-                parse_mode="Markdown"
-            )
-        except Exception as e:
-            logger.warning(f"Не удалось уведомить пользователя {order['user_id']}: {e}")
+        await queue_notification(
+            f"order_cancelled:{order_id}",
+            bot_call('send_message', chat_id=order['user_id'], text=user_notification, parse_mode="Markdown")
+        )
 
         try:
-            await safe_delete_message(message.bot, chat_id, original_message_id)
+            if data.get('from_dashboard'):
+                await _show_order_result(message.bot, chat_id, original_message_id, state, True, order_id)
+            elif original_message_id:
+                await _show_order_result(message.bot, chat_id, original_message_id, state, False, order_id, 'cancelled')
         except Exception as e:
-            logger.warning(f"Не удалось удалить оригинальное сообщение: {e}")
+            logger.warning(f"Не удалось обновить оригинальное сообщение: {e}")
 
         await message.answer(f"❌ Заказ #{order_id} отменен. Клиент уведомлен о причине отмены.")
 
@@ -1693,4 +1780,4 @@ async def admin_finish_cancel_order(message: Message, state: FSMContext):
         await message.answer("Произошла ошибка при отмене заказа")
 
     finally:
-        await state.clear()
\ No newline at end of file
+        await _clear_keeping_orders_view(state)
\ No newline at end of file
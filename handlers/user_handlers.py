@@ -2,18 +2,17 @@ from aiogram import Router, F
 from aiogram.filters import Command, StateFilter
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton
+from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton, InputMediaPhoto
+from aiogram.exceptions import TelegramBadRequest
 from datetime import datetime, timedelta
 import logging
 import asyncio
-from collections import defaultdict
 
 from database import db
 from keyboards.user_kb import (
     main_menu,
     catalog_menu,
-    product_actions_kb,
-    cart_actions_kb,
+    catalog_page_kb,
     help_menu,
     cart_full_kb,
     help_button_kb
@@ -22,7 +21,10 @@ from keyboards.admin_kb import order_management_kb
 from config import ADMIN_ID, ADMIN_CARD,ADMIN_SWITCHING, CATEGORIES, ADMIN_CARD_NAME
 from handlers.admin_handlers import format_order_notification
 from utils.sleep_mode import check_sleep_mode
-from utils.message_utils import safe_delete_message
+from utils.message_utils import safe_delete_message, safe_delete_messages
+from utils.outbox import bot_call, queue_notification
+from utils.panel import render_panel
+from utils.user_session import UserSession
 from texts import (
     CATALOG_MESSAGE,
     CATEGORY_EMPTY,
@@ -61,7 +63,6 @@ from texts import (
     CHECKOUT_ORDER_CREATED,
     CHECKOUT_ORDER_CREATION_ERROR,
     HELP_MENU,
-    RATE_LIMIT_WARNING,
     GENERAL_ERROR,
     CALLBACK_ERROR,
     FLAVOR_INDEX_ERROR,
@@ -84,58 +85,12 @@ from utils.text_manager import get_text
 
 user_log = logging.getLogger(__name__)#Инициализация логера
 
-# Система защиты от спама
-user_last_click = defaultdict(dict)  # {user_id: {callback_data: timestamp}}
-RATE_LIMIT_SECONDS = 1  # Минимальный интервал между нажатиями (в секундах)
+CART_CLEANUP_INTERVAL = 60  # Максимальный интервал проверки истекших корзин (в секундах)
+CART_CLEANUP_MIN_DELAY = 1  # Минимальная пауза между проверками (в секундах)
 
-async def check_rate_limit(user_id: int, callback_data: str) -> bool:
-    """Проверяет, не слишком ли часто пользователь нажимает кнопки"""
-    current_time = datetime.now()
-    
-    # Получаем время последнего нажатия для этого пользователя и кнопки
-    user_clicks = user_last_click.get(user_id, {})
-    last_click_time = user_clicks.get(callback_data)
-    
-    if last_click_time:
-        time_diff = (current_time - last_click_time).total_seconds()
-        if time_diff < RATE_LIMIT_SECONDS:
-            return False  # Слишком часто
-    
-    # Обновляем время последнего нажатия
-    user_last_click[user_id][callback_data] = current_time
-    return True  # Можно нажимать
-
-async def cleanup_old_rate_limits():#авототчистка старых записаей антиспама
-    current_time = datetime.now()
-    cleanup_threshold = 3600  # 1 час
-    
-    for user_id in list(user_last_click.keys()):
-        user_clicks = user_last_click[user_id]
-        for callback_data in list(user_clicks.keys()):
-            last_click_time = user_clicks[callback_data]
-            if (current_time - last_click_time).total_seconds() > cleanup_threshold:
-                del user_clicks[callback_data]
-        
-        if not user_clicks:
-            del user_last_click[user_id]
-
-async def start_rate_limit_cleanup():# Запускаем периодическую очистку каждые 30 минут
-    while True:
-        await asyncio.sleep(1800)  # 30 минут
-        await cleanup_old_rate_limits()
-
-def rate_limit_protected(func):#Декоратор для автоматической защиты от спама
-    async def wrapper(callback: CallbackQuery, *args, **kwargs):
-        if not await check_rate_limit(callback.from_user.id, callback.data):
-            await callback.answer(RATE_LIMIT_WARNING, show_alert=True)
-            return
-        return await func(callback, *args, **kwargs)
-    return wrapper
-
-async def init_rate_limit_cleanup(bot=None):#Инициализирует периодическую очистку rate limiting и корзин
-    asyncio.create_task(start_rate_limit_cleanup())
-    asyncio.create_task(start_cart_cleanup(bot))
-    user_log.info("Rate limit and cart cleanup tasks started")
+async def init_cart_cleanup():#Запускает фоновую очистку истекших корзин
+    asyncio.create_task(start_cart_cleanup())
+    user_log.info("Cart cleanup task started")
 
 router = Router()
 
@@ -182,37 +137,30 @@ async def show_catalog(message: Message, state: FSMContext):
     try:
         data = await state.get_data()
         
-        # Удаляем предыдущее сообщение каталога
-        catalog_message_id = data.get('catalog_message_id')
-        if catalog_message_id:
-            await safe_delete_message(message.bot, message.chat.id, catalog_message_id)
-        
-        # Удаляем карточки товаров
+        # Удаляем предыдущие каталог, карточки товаров, корзину и помощь одним пакетом в фоне
         product_message_ids = data.get('product_message_ids', [])
+        await safe_delete_messages(message.bot, message.chat.id, [
+            data.get('catalog_message_id'),
+            *product_message_ids,
+            data.get('cart_message_id'),
+            data.get('help_message_id')
+        ], background=True)
+        
         if product_message_ids:
-            for message_id in product_message_ids:
-                await safe_delete_message(message.bot, message.chat.id, message_id)
-            
             # Очищаем список ID карточек товаров
             await state.update_data(product_message_ids=[])
-        
-        # Удаляем сообщения корзины
-        cart_message_id = data.get('cart_message_id')
-        if cart_message_id:
-            await safe_delete_message(message.bot, message.chat.id, cart_message_id)
-        
-        # Удаляем сообщения помощи
-        help_message_id = data.get('help_message_id')
-        if help_message_id:
-            await safe_delete_message(message.bot, message.chat.id, help_message_id)
     except Exception as e:
         user_log.error(f"Ошибка при удалении предыдущих сообщений: {e}")
 
-    catalog_msg = await message.answer(
-        "Выберите категорию:",
-        reply_markup=catalog_menu()
-    )
-    await state.update_data(catalog_message_id=catalog_msg.message_id)
+    catalog_message_id = await render_panel(message.bot, message.chat.id, state, "Выберите категорию:", catalog_menu())
+    await state.update_data(catalog_message_id=catalog_message_id)
+
+def build_catalog_page(products: list, page: int):
+    """Возвращает фото, подпись и клавиатуру для страницы каталога"""
+    product = products[page]
+    caption = build_product_caption(product)
+    keyboard = catalog_page_kb(str(product['_id']), product.get('flavors', []), page, len(products))
+    return product['photo'], caption, keyboard
 
 @router.callback_query(F.data.startswith("category_"))#создание категорий
 async def show_category(callback: CallbackQuery, state: FSMContext):
@@ -231,37 +179,73 @@ async def show_category(callback: CallbackQuery, state: FSMContext):
             return
         
         await delete_previous_callback_messages(callback, state, "catalog")
-        
-        product_message_ids = []
-        
-        for product in products:
-            product_id = str(product['_id'])
-            try:
-                caption = build_product_caption(product)
-                keyboard = product_actions_kb(product_id, False, product.get('flavors', []))
-                
-                product_msg = await callback.message.answer_photo(
-                    photo=product['photo'],
-                    caption=caption,
-                    reply_markup=keyboard
-                )
-                product_message_ids.append(product_msg.message_id)
-            except Exception as e:
-                user_log.error(f"Ошибка отображения товара {product_id}: {e}")
-                await callback.message.answer(PRODUCT_DISPLAY_ERROR.format(name=product.get('name', 'Неизвестно')))
+        await delete_product_cards(callback, state)
+
+        # Одна карточка на категорию, товары листаются кнопками ⬅️/➡️
+        try:
+            photo, caption, keyboard = build_catalog_page(products, 0)
+            product_msg = await callback.message.answer_photo(
+                photo=photo,
+                caption=caption,
+                reply_markup=keyboard
+            )
+        except Exception as e:
+            user_log.error(f"Ошибка отображения товара {products[0].get('_id')}: {e}")
+            await callback.message.answer(PRODUCT_DISPLAY_ERROR.format(name=products[0].get('name', 'Неизвестно')))
+            await callback.answer()
+            return
 
-        await state.update_data(product_message_ids=product_message_ids)
+        await state.update_data(product_message_ids=[product_msg.message_id], catalog_category=category)
         await callback.answer()
 
     except Exception as e:
         user_log.error(f"Ошибка в show_category: {e}")
         await callback.answer(CATALOG_ERROR)
 
+@router.callback_query(F.data.startswith("catalog_page_"))#листание товаров категории
+async def show_catalog_page(callback: CallbackQuery, state: FSMContext):
+    try:
+        if await check_sleep_mode(callback):
+            return
+
+        try:
+            page = int(callback.data.replace("catalog_page_", ""))
+        except ValueError:
+            await callback.answer(CALLBACK_ERROR)
+            return
+
+        data = await state.get_data()
+        products = await db.get_products_by_category(data.get('catalog_category'))
+        if not products:
+            await callback.answer(CATEGORY_EMPTY, show_alert=True)
+            return
+
+        # Каталог мог измениться с момента отрисовки кнопок
+        page = max(0, min(page, len(products) - 1))
+        photo, caption, keyboard = build_catalog_page(products, page)
+
+        try:
+            await callback.message.edit_media(
+                media=InputMediaPhoto(media=photo, caption=caption),
+                reply_markup=keyboard
+            )
+        except TelegramBadRequest as e:
+            if "message is not modified" not in str(e):
+                raise
+        await callback.answer()
+
+    except Exception as e:
+        user_log.error(f"Ошибка в show_catalog_page: {e}")
+        await callback.answer(CATALOG_ERROR)
+
+@router.callback_query(F.data == "noop")#кнопки без действия (номер страницы, название товара)
+async def noop_callback(callback: CallbackQuery):
+    await callback.answer()
+
 # Удаляем функцию build_product_caption, так как она теперь в texts.py
 
-@router.callback_query(F.data.startswith("sf_"))#создание и обработка кнопок выбора вкуса
-@rate_limit_protected
-async def select_flavor(callback: CallbackQuery, *args, **kwargs):
+@router.callback_query(F.data.startswith("sf_"), flags={"rate_limit": True})#создание и обработка кнопок выбора вкуса
+async def select_flavor(callback: CallbackQuery, session: UserSession, *args, **kwargs):
     try:
         # Check sleep mode
         if await check_sleep_mode(callback):
@@ -294,10 +278,14 @@ async def select_flavor(callback: CallbackQuery, *args, **kwargs):
             await callback.answer(PRODUCT_OUT_OF_STOCK_ERROR)
             return
 
-        user = await db.get_user(callback.from_user.id)
+        user = await session.get()
         if not user:
-            user = {'user_id': callback.from_user.id, 'username': callback.from_user.username, 'cart': []}
-            await db.create_user(user)
+            user = await session.create(
+                {'user_id': callback.from_user.id, 'username': callback.from_user.username, 'cart': []}
+            )
+            if not user:
+                await callback.answer(GENERAL_ERROR)
+                return
 
         cart = user.get("cart", [])
         if any(item['product_id'] == product_id and item['flavor'] == flavor['name'] for item in cart):
@@ -305,23 +293,27 @@ async def select_flavor(callback: CallbackQuery, *args, **kwargs):
             return
 
         # Atomic deduction
-        success = await db.update_product_flavor_quantity(product_id, flavor['name'], -1)
-        if not success:
+        new_quantity = await db.update_product_flavor_quantity(product_id, flavor['name'], -1)
+        if new_quantity is None:
             await callback.answer(PRODUCT_OUT_OF_STOCK_ERROR, show_alert=True)
             return
 
-        cart.append({
+        updated = await db.add_cart_line(callback.from_user.id, {
             'product_id': product_id,
             'name': product['name'],
             'price': product['price'],
             'flavor': flavor['name'],
             'quantity': 1
-        })
-
-        await db.update_user(callback.from_user.id, {
-            'cart': cart,
-            'cart_expires_at': (datetime.now() + timedelta(minutes=5)).isoformat()
-        })
+        }, (datetime.now() + timedelta(minutes=5)).isoformat())
+        if not updated:
+            # Строка уже в корзине или запись не удалась — возвращаем резерв
+            await db.update_product_flavor_quantity(product_id, flavor['name'], 1)
+            if updated is None:
+                await callback.answer(PRODUCT_ALREADY_IN_CART, show_alert=True)
+            else:
+                await callback.answer(GENERAL_ERROR)
+            return
+        session.refresh(updated)
 
         await callback.answer(PRODUCT_ADDED_TO_CART, show_alert=True)
 
@@ -337,24 +329,25 @@ async def back_to_catalog_handler(callback: CallbackQuery, state: FSMContext):
             await callback.answer(CATEGORIES_NOT_FOUND, show_alert=True)
             return
 
-        await delete_product_cards(callback, state)
-        await delete_previous_callback_messages(callback, state, "cart")
-
-        await safe_delete_message(callback.message)
-
         keyboard = catalog_menu()
         if not keyboard.inline_keyboard:
             user_log.error("⚠️ Клавиатура каталога пуста!")
             await callback.answer(CATALOG_EMPTY_ERROR, show_alert=True)
             return
 
-        msg = await callback.bot.send_message(
-            chat_id=callback.message.chat.id,
-            text=CATALOG_MESSAGE,
-            reply_markup=keyboard
+        # Каталог открывается на месте нажатой кнопки, остальные карточки и корзина удаляются в фоне
+        data = await state.get_data()
+        await safe_delete_messages(callback.bot, callback.message.chat.id, [
+            message_id
+            for message_id in (*data.get('product_message_ids', []), data.get('cart_message_id'))
+            if message_id != callback.message.message_id
+        ], background=True)
+
+        catalog_message_id = await render_panel(
+            callback.bot, callback.message.chat.id, state, CATALOG_MESSAGE, keyboard,
+            edit_message_id=callback.message.message_id
         )
-
-        await state.update_data(catalog_message_id=msg.message_id)
+        await state.update_data(catalog_message_id=catalog_message_id, product_message_ids=[])
         await callback.answer()
 
     except Exception as e:
@@ -362,7 +355,7 @@ async def back_to_catalog_handler(callback: CallbackQuery, state: FSMContext):
         await callback.answer(GENERAL_ERROR)
 
 @router.message(F.text == "🛒 Корзина")#обработка клавиатурной кнопки корзина
-async def show_cart(message: Message, state: FSMContext):
+async def show_cart(message: Message, state: FSMContext, session: UserSession):
     try:
         # Удаляем приветственное сообщение
         await safe_delete_message(message.bot, message.chat.id, message.message_id)
@@ -374,65 +367,47 @@ async def show_cart(message: Message, state: FSMContext):
         try:
             data = await state.get_data()
             
-            # Удаляем сообщение каталога
-            catalog_message_id = data.get('catalog_message_id')
-            if catalog_message_id:
-                await safe_delete_message(message.bot, message.chat.id, catalog_message_id)
-            
-            # Удаляем карточки товаров
-            product_message_ids = data.get('product_message_ids', [])
-            if product_message_ids:
-                for message_id in product_message_ids:
-                    await safe_delete_message(message.bot, message.chat.id, message_id)
-            
-            # Удаляем сообщения помощи
-            help_message_id = data.get('help_message_id')
-            if help_message_id:
-                await safe_delete_message(message.bot, message.chat.id, help_message_id)
+            # Удаляем каталог, карточки товаров и помощь одним пакетом в фоне
+            await safe_delete_messages(message.bot, message.chat.id, [
+                data.get('catalog_message_id'),
+                *data.get('product_message_ids', []),
+                data.get('help_message_id')
+            ], background=True)
         except Exception as e:
             user_log.error(f"Ошибка при удалении предыдущих сообщений: {e}")
 
-        user = await db.get_user(message.from_user.id)
+        user = await session.get()
         await show_cart_message(message, user, state)
     except Exception as e:
         user_log.error(f"Error in show_cart: {str(e)}")
         await message.answer(CART_ERROR, reply_markup=main_menu())
 
 
-async def show_cart_message(message: Message, user: dict, state: FSMContext = None):
+async def show_cart_message(message: Message, user: dict, state: FSMContext, edit: bool = False):
+    """Показывает корзину в активной панели; edit=True — на месте message (нажатие в корзине)"""
+    keyboard, parse_mode = None, None  # Reply-клавиатура главного меню остаётся с /start
     # Проверяем истечение корзины
     if await check_cart_expiration(user):
         await clear_expired_cart(user['user_id'])
-        cart_msg = await message.answer(
-            CART_EXPIRED,
-            reply_markup=main_menu()
-        )
-        if state:
-            await state.update_data(cart_message_id=cart_msg.message_id)
-        return
-
-    if not user or not user.get('cart'):
-        cart_msg = await message.answer(
-            CART_EMPTY,
-            reply_markup=main_menu()
-        )
-        if state:
-            await state.update_data(cart_message_id=cart_msg.message_id)
-        return
-
-    cart = user['cart']
-    total = sum(item['price'] * item['quantity'] for item in cart)
-    text = build_cart_text(cart, total)
-
-    keyboard = cart_full_kb(cart)
-    cart_msg = await message.answer(text, reply_markup=keyboard, parse_mode="HTML")
+        text = CART_EXPIRED
+    elif not user or not user.get('cart'):
+        text = CART_EMPTY
+    else:
+        cart = user['cart']
+        total = sum(item['price'] * item['quantity'] for item in cart)
+        text = build_cart_text(cart, total)
+        keyboard, parse_mode = cart_full_kb(cart), "HTML"
 
-    if state:
-        await state.update_data(cart_message_id=cart_msg.message_id)
+    cart_message_id = await render_panel(
+        message.bot, message.chat.id, state, text, keyboard,
+        edit_message_id=message.message_id if edit else None,
+        parse_mode=parse_mode
+    )
+    await state.update_data(cart_message_id=cart_message_id)
 
 
-async def get_cart_item(user_id: int, product_id: str):#вспомогательная функция для изменеиния количества в корзине
-    user = await db.get_user(user_id)
+async def get_cart_item(session: UserSession, product_id: str):#вспомогательная функция для изменеиния количества в корзине
+    user = await session.get()
     if not user or not user.get('cart'):
         return None, None
     cart = user['cart']
@@ -440,17 +415,29 @@ async def get_cart_item(user_id: int, product_id: str):#вспомогатель
     return user, item
 
 
-@router.callback_query(F.data.startswith("increase_"))#увелечения количества вкусов в корзине
-async def increase_cart_item(callback: CallbackQuery, state: FSMContext):
+async def restore_cart_line(session: UserSession, item: dict, removed: bool, quantity: int):
+    """Возвращает в корзину quantity единиц строки, если их не удалось вернуть на склад"""
+    expires_at = (datetime.now() + timedelta(minutes=10)).isoformat()
+    if removed:
+        restored = await db.add_cart_line(session.user_id, {**item, 'quantity': quantity}, expires_at)
+    else:
+        restored = await db.change_cart_quantity(
+            session.user_id, item['product_id'], item.get('flavor'), quantity, expires_at
+        )
+    if restored:
+        session.refresh(restored)
+    else:
+        user_log.error(
+            f"Не удалось вернуть {quantity} шт. {item['product_id']} ({item.get('flavor')}) "
+            f"ни на склад, ни в корзину пользователя {session.user_id}"
+        )
+
+
+@router.callback_query(F.data.startswith("increase_"), flags={"rate_limit": True})#увелечения количества вкусов в корзине
+async def increase_cart_item(callback: CallbackQuery, state: FSMContext, session: UserSession):
     try:
-        # Проверка rate limit
-        if not await check_rate_limit(callback.from_user.id, callback.data):
-            await callback.answer(RATE_LIMIT_WARNING, show_alert=True)
-            return
-            
-        await delete_previous_callback_messages(callback, state, "cart")
         product_id = callback.data.replace("increase_", "")
-        user, item = await get_cart_item(callback.from_user.id, product_id)
+        user, item = await get_cart_item(session, product_id)
 
         # Проверяем истечение корзины
         if await check_cart_expiration(user):
@@ -462,46 +449,39 @@ async def increase_cart_item(callback: CallbackQuery, state: FSMContext):
             await callback.answer(QUANTITY_ITEM_NOT_FOUND)
             return
 
-        product = await db.get_product(product_id)
-        if not product:
-            await callback.answer(PRODUCT_NO_LONGER_AVAILABLE)
-            return
-
         if 'flavor' in item:
-            flavor = next((f for f in product.get('flavors', []) if f.get('name') == item['flavor']), None)
-            if not flavor or flavor.get('quantity', 0) <= 0:
+            # Guarded reservation: fails if the product is gone or out of stock
+            if await db.update_product_flavor_quantity(product_id, item['flavor'], -1) is None:
                 await callback.answer(QUANTITY_NO_STOCK)
                 return
-            if not await db.update_product_flavor_quantity(product_id, item['flavor'], -1):
-                await callback.answer(PRODUCT_UPDATE_ERROR, show_alert=True)
-                return
-
-        item['quantity'] += 1
-        user['cart_expires_at'] = (datetime.now() + timedelta(minutes=10)).isoformat()
+        elif not await db.get_product(product_id):
+            # Товар без вкусов не резервируется, поэтому его наличие проверяем отдельно
+            await callback.answer(PRODUCT_NO_LONGER_AVAILABLE)
+            return
 
-        await db.update_user(callback.from_user.id, {
-            'cart': user['cart'],
-            'cart_expires_at': user['cart_expires_at']
-        })
+        updated = await db.change_cart_quantity(
+            callback.from_user.id, item['product_id'], item.get('flavor'), 1,
+            (datetime.now() + timedelta(minutes=10)).isoformat()
+        )
+        if updated is None:
+            if 'flavor' in item:
+                await db.update_product_flavor_quantity(product_id, item['flavor'], 1)
+            await callback.answer(QUANTITY_ITEM_NOT_FOUND)
+            return
+        session.refresh(updated)
 
-        await show_cart_message(callback.message, user, state)
+        await show_cart_message(callback.message, user, state, edit=True)
         await callback.answer(QUANTITY_INCREASED)
     except Exception as e:
         user_log.error(f"Error in increase_cart_item: {e}")
         await callback.answer(GENERAL_ERROR)
 
 
-@router.callback_query(F.data.startswith("decrease_"))#уменьшения количества вкусов в корзине
-async def decrease_cart_item(callback: CallbackQuery, state: FSMContext):
+@router.callback_query(F.data.startswith("decrease_"), flags={"rate_limit": True})#уменьшения количества вкусов в корзине
+async def decrease_cart_item(callback: CallbackQuery, state: FSMContext, session: UserSession):
     try:
-        # Проверка rate limit
-        if not await check_rate_limit(callback.from_user.id, callback.data):
-            await callback.answer(RATE_LIMIT_WARNING, show_alert=True)
-            return
-            
-        await delete_previous_callback_messages(callback, state, "cart")
         product_id = callback.data.replace("decrease_", "")
-        user, item = await get_cart_item(callback.from_user.id, product_id)
+        user, item = await get_cart_item(session, product_id)
 
         # Проверяем истечение корзины
         if await check_cart_expiration(user):
@@ -513,64 +493,63 @@ async def decrease_cart_item(callback: CallbackQuery, state: FSMContext):
             await callback.answer(QUANTITY_ITEM_NOT_FOUND)
             return
 
-        if 'flavor' in item:
-            if not await db.update_product_flavor_quantity(product_id, item['flavor'], 1):
-                await callback.answer(PRODUCT_UPDATE_ERROR, show_alert=True)
-                return
-
+        # Сначала меняем корзину, затем возвращаем товар — иначе при гонке остаток задвоится
+        expires_at = (datetime.now() + timedelta(minutes=10)).isoformat()
         if item['quantity'] > 1:
-            item['quantity'] -= 1
+            updated = await db.change_cart_quantity(
+                callback.from_user.id, item['product_id'], item.get('flavor'), -1, expires_at
+            )
         else:
-            user['cart'].remove(item)
-
-        user['cart_expires_at'] = (
-            (datetime.now() + timedelta(minutes=10)).isoformat() if user['cart'] else None
-        )
+            updated = await db.remove_cart_line(
+                callback.from_user.id, item['product_id'], item.get('flavor'), expires_at
+            )
+        if updated is None:
+            await callback.answer(QUANTITY_ITEM_NOT_FOUND)
+            return
+        session.refresh(updated)
 
-        await db.update_user(callback.from_user.id, {
-            'cart': user['cart'],
-            'cart_expires_at': user['cart_expires_at']
-        })
+        if 'flavor' in item:
+            if await db.update_product_flavor_quantity(product_id, item['flavor'], 1) is None:
+                # Товар не вернулся на склад — возвращаем единицу в корзину, чтобы она не пропала
+                await restore_cart_line(session, item, removed=item['quantity'] == 1, quantity=1)
+                await callback.answer(PRODUCT_UPDATE_ERROR, show_alert=True)
+                return
 
-        await show_cart_message(callback.message, user, state)
+        await show_cart_message(callback.message, user, state, edit=True)
         await callback.answer(QUANTITY_DECREASED)
     except Exception as e:
         user_log.error(f"Error in decrease_cart_item: {e}")
         await callback.answer(GENERAL_ERROR)
 
 
-@router.callback_query(F.data == "clear_cart")
-async def clear_cart(callback: CallbackQuery, state: FSMContext):
+@router.callback_query(F.data == "clear_cart", flags={"rate_limit": True})
+async def clear_cart(callback: CallbackQuery, state: FSMContext, session: UserSession):
     try:
-        # Проверка rate limit
-        if not await check_rate_limit(callback.from_user.id, callback.data):
-            await callback.answer(RATE_LIMIT_WARNING, show_alert=True)
-            return
-            
-        # Удаляем предыдущие сообщения корзины
-        await delete_previous_callback_messages(callback, state, "cart")
-        
-        user = await db.get_user(callback.from_user.id)
+        user = await session.get()
         if not user or not user.get('cart'):
             await callback.answer(CART_ALREADY_EMPTY)
             return
             
-        # Return all flavors to inventory using atomic operations
-        for item in user['cart']:
-            if 'flavor' in item:
-                await db.update_product_flavor_quantity(
-                    item['product_id'],
-                    item['flavor'],
-                    item['quantity']
-                )
-        
-        # Clear cart and expiration time
-        await db.update_user(callback.from_user.id, {
-            'cart': [],
-            'cart_expires_at': None
-        })
+        # Atomically take the cart first: only the lines actually taken go back to inventory,
+        # so a concurrent expiry sweep cannot return the same stock twice
+        cart = await db.take_cart(callback.from_user.id)
+        if cart is False:
+            await callback.answer(GENERAL_ERROR)
+            return
+        session.refresh({"cart": [], "cart_expires_at": None})
+        if not cart:
+            await callback.answer(CART_ALREADY_EMPTY)
+            return
+
+        # Return all flavors to inventory in a single bulk operation
+        await db.release_items(cart)
         
-        await callback.message.answer(CART_CLEARED, reply_markup=main_menu())
+        # Корзина превращается в сообщение об очистке на месте
+        cart_message_id = await render_panel(
+            callback.bot, callback.message.chat.id, state, CART_CLEARED,
+            edit_message_id=callback.message.message_id
+        )
+        await state.update_data(cart_message_id=cart_message_id)
         await callback.answer(CART_CLEARED)
         
     except Exception as e:
@@ -578,67 +557,51 @@ async def clear_cart(callback: CallbackQuery, state: FSMContext):
         await callback.answer(GENERAL_ERROR)
 
 @router.callback_query(F.data.startswith("remove_"))
-async def remove_item(callback: CallbackQuery, state: FSMContext):
+async def remove_item(callback: CallbackQuery, state: FSMContext, session: UserSession):
     try:
-        # Удаляем предыдущие сообщения корзины
-        await delete_previous_callback_messages(callback, state, "cart")
-
         product_id = callback.data.replace("remove_", "")
-        user, item = await get_cart_item(callback.from_user.id, product_id)
+        user, item = await get_cart_item(session, product_id)
         
         if not user or not item:
             await callback.answer(ITEM_NOT_FOUND)
             return
             
+        # Remove item from cart (expiration is dropped if the cart becomes empty)
+        updated = await db.remove_cart_line(
+            callback.from_user.id, item['product_id'], item.get('flavor'),
+            (datetime.now() + timedelta(minutes=10)).isoformat()
+        )
+        if updated is None:
+            await callback.answer(ITEM_NOT_FOUND)
+            return
+        session.refresh(updated)
+
         # Return all quantity of the flavor to inventory
-        if 'flavor' in item:
-            success = await db.update_product_flavor_quantity(
-                product_id,
-                item['flavor'],
-                item['quantity']
-            )
-            if not success:
-                await callback.answer(ITEM_UPDATE_ERROR, show_alert=True)
-                return
-        
-        # Remove item from cart
-        user['cart'].remove(item)
-        
-        # Update cart expiration time if cart is not empty
-        if user['cart']:
-            user['cart_expires_at'] = (datetime.now() + timedelta(minutes=10)).isoformat()
-        else:
-            user['cart_expires_at'] = None
-            
-        # Update user's cart
-        await db.update_user(callback.from_user.id, {
-            'cart': user['cart'],
-            'cart_expires_at': user['cart_expires_at']
-        })
+        results = await db.release_items([item])
+        if not all(result['success'] for result in results):
+            # Товар не вернулся на склад — возвращаем строку в корзину, чтобы он не пропал
+            await restore_cart_line(session, item, removed=True, quantity=item['quantity'])
+            await callback.answer(ITEM_UPDATE_ERROR, show_alert=True)
+            return
         
         # Show updated cart
-        await show_cart_message(callback.message, user, state)
+        await show_cart_message(callback.message, user, state, edit=True)
         await callback.answer(ITEM_REMOVED)
         
     except Exception as e:
         user_log.error(f"Error in remove_item: {str(e)}")
         await callback.answer(GENERAL_ERROR)
 
-@router.callback_query(F.data == "checkout")
-async def start_checkout(callback: CallbackQuery, state: FSMContext):
+@router.callback_query(F.data == "checkout", flags={"rate_limit": True})
+async def start_checkout(callback: CallbackQuery, state: FSMContext, session: UserSession):
     try:
-        # Проверка rate limit
-        if not await check_rate_limit(callback.from_user.id, callback.data):
-            await callback.answer("⚠️ Подождите немного перед следующим нажатием", show_alert=True)
-            return
-            
         # Удаляем предыдущие сообщения корзины
         await delete_previous_callback_messages(callback, state, "cart")
         
         if await check_sleep_mode(callback):
             return
     
-        user = await db.get_user(callback.from_user.id)
+        user = await session.get()
         if not user or not user.get('cart'):
             await callback.message.answer("Ваша корзина пуста")
             await callback.answer()
@@ -654,8 +617,12 @@ async def start_checkout(callback: CallbackQuery, state: FSMContext):
         liquid_total = 0
         
         # Count category totals
+        products = await db.get_products_by_ids(
+            [item['product_id'] for item in cart],
+            projection={'category': 1}
+        )
         for item in cart:
-            product = await db.get_product(item['product_id'])
+            product = products.get(str(item['product_id']))
             if not product:
                 await callback.message.answer(f"Товар {item['name']} больше не доступен")
                 await callback.answer()
@@ -734,14 +701,14 @@ async def process_phone(message: Message, state: FSMContext):
         await state.clear()
 
 @router.message(OrderStates.waiting_address)
-async def process_address(message: Message, state: FSMContext):
+async def process_address(message: Message, state: FSMContext, session: UserSession):
     try:
         if await check_sleep_mode(message):
             return
             
         # Get all order data
         data = await state.get_data()
-        user = await db.get_user(message.from_user.id)
+        user = await session.get()
         
         # Создание ссылки на 2GIS
         address = message.text.strip()
@@ -775,7 +742,7 @@ async def process_address(message: Message, state: FSMContext):
         await state.clear()
 
 @router.message(OrderStates.waiting_payment)
-async def handle_payment_proof(message: Message, state: FSMContext):
+async def handle_payment_proof(message: Message, state: FSMContext, session: UserSession):
     try:
         if await check_sleep_mode(message):
             return
@@ -797,7 +764,7 @@ async def handle_payment_proof(message: Message, state: FSMContext):
             await state.clear()
             return
 
-        user = await db.get_user(message.from_user.id)
+        user = await session.get()
         if not user or not user.get('cart'):
             await message.answer(CHECKOUT_ORDER_ERROR, reply_markup=main_menu())
             await state.clear()
@@ -821,60 +788,53 @@ async def handle_payment_proof(message: Message, state: FSMContext):
             'payment_file_type': file_type
         }
         
-        # Create order in database
-        order_result = await db.create_order(order_data)
-        if not order_result:
-            await message.answer(CHECKOUT_ORDER_CREATION_ERROR, reply_markup=main_menu())
-            await state.clear()
-            return
-            
-        order_id = order_result  # create_order возвращает строку с ID
-        
-        # Clear user's cart
-        await db.update_user(message.from_user.id, {'cart': []})
-        
-        # Send confirmation to user
-        await message.answer(CHECKOUT_ORDER_CREATED, reply_markup=main_menu())
-        
         # Prepare user data for notification
         user_data = {
             'full_name': message.from_user.full_name,
             'username': message.from_user.username
         }
-        
-        # Format and send admin notification
-        admin_text = format_order_notification(
-            order_id=order_id,
-            user_data=user_data,
-            order_data=data,
-            cart=cart,
-            total=total
-        )
-        
-        try:
-            # First send the order details
-            await message.bot.send_message(
-                chat_id=ADMIN_ID,
-                text=admin_text
+
+        def build_admin_notification(order_id: str) -> list:
+            admin_text = format_order_notification(
+                order_id=order_id,
+                user_data=user_data,
+                order_data=data,
+                cart=cart,
+                total=total
             )
-            
-            # Then send the payment proof
+            # First the order details, then the payment proof
             if file_type == 'photo':
-                await message.bot.send_photo(
+                proof = bot_call(
+                    'send_photo',
                     chat_id=ADMIN_ID,
                     photo=file_id,
                     caption=ADMIN_PAYMENT_PHOTO_CAPTION.format(order_id=order_id),
                     reply_markup=order_management_kb(order_id)
                 )
             else:
-                await message.bot.send_document(
+                proof = bot_call(
+                    'send_document',
                     chat_id=ADMIN_ID,
                     document=file_id,
                     caption=ADMIN_PAYMENT_DOCUMENT_CAPTION.format(order_id=order_id),
                     reply_markup=order_management_kb(order_id)
                 )
-        except Exception as e:
-            user_log.error(f"Failed to notify admin about order {order_id}: {str(e)}")
+            return [bot_call('send_message', chat_id=ADMIN_ID, text=admin_text), proof]
+
+        # Order, cart clearing and admin notification are committed together;
+        # the notification itself is delivered in the background by the outbox worker
+        order_id, _ = await db.checkout_order(
+            order_data,
+            idempotency_key=f"{message.chat.id}:{message.message_id}",
+            build_notification=build_admin_notification
+        )
+        if not order_id:
+            await message.answer(CHECKOUT_ORDER_CREATION_ERROR, reply_markup=main_menu())
+            await state.clear()
+            return
+        
+        # Send confirmation to user
+        await message.answer(CHECKOUT_ORDER_CREATED, reply_markup=main_menu())
         
         await state.clear()
         
@@ -905,24 +865,17 @@ async def show_help_menu(message: Message, state: FSMContext):
     try:
         data = await state.get_data()
         
-        # Удаляем сообщение каталога
-        catalog_message_id = data.get('catalog_message_id')
-        if catalog_message_id:
-            await safe_delete_message(message.bot, message.chat.id, catalog_message_id)
-        
-        # Удаляем карточки товаров
+        # Удаляем каталог, карточки товаров и корзину одним пакетом в фоне
         product_message_ids = data.get('product_message_ids', [])
+        await safe_delete_messages(message.bot, message.chat.id, [
+            data.get('catalog_message_id'),
+            *product_message_ids,
+            data.get('cart_message_id')
+        ], background=True)
+        
         if product_message_ids:
-            for message_id in product_message_ids:
-                await safe_delete_message(message.bot, message.chat.id, message_id)
-            
             # Очищаем список ID карточек товаров
             await state.update_data(product_message_ids=[])
-        
-        # Удаляем сообщения корзины
-        cart_message_id = data.get('cart_message_id')
-        if cart_message_id:
-            await safe_delete_message(message.bot, message.chat.id, cart_message_id)
     except Exception as e:
         user_log.error(f"Ошибка при удалении предыдущих сообщений: {e}")
     
@@ -930,74 +883,39 @@ async def show_help_menu(message: Message, state: FSMContext):
 
 @router.callback_query(F.data == "show_help")  #Обработчик inline кнопки Помошь
 async def show_help_from_button(callback: CallbackQuery, state: FSMContext):
-    try:
-        # Удаляем приветственное сообщение
-        await safe_delete_message(callback.message.bot, callback.message.chat.id, callback.message.message_id)
-        await safe_delete_message(callback.message)
-    except Exception:
-        pass
-
-    await send_help_menu(callback.message, state)
+    await send_help_menu(callback.message, state, edit=True)
     await callback.answer()
     
-async def send_help_menu(target_message: Message, state: FSMContext = None):#Вызов меню помощи
-    """Общая функция для отправки меню помощи"""
-    help_msg = await target_message.answer(
-        HELP_MENU,
-        reply_markup=help_menu()
+async def send_help_menu(target_message: Message, state: FSMContext, edit: bool = False):#Вызов меню помощи
+    """Общая функция для показа меню помощи (edit=True — на месте target_message)"""
+    await show_help_section(target_message, state, HELP_MENU, edit)
+
+async def show_help_section(target_message: Message, state: FSMContext, text: str, edit: bool = True):
+    """Показывает раздел помощи в активной панели"""
+    help_message_id = await render_panel(
+        target_message.bot, target_message.chat.id, state, text, help_menu(),
+        edit_message_id=target_message.message_id if edit else None
     )
-    if state:
-        await state.update_data(help_message_id=help_msg.message_id)
+    await state.update_data(help_message_id=help_message_id)
 
 @router.callback_query(F.data == "help_how_to_order")#Раздел помоши (Заказ)
 async def show_how_to_order(callback: CallbackQuery, state: FSMContext):
-    try:
-        # Удаляем предыдущие сообщения помощи
-        await delete_previous_callback_messages(callback, state, "help")
-    except Exception as e:
-        user_log.error(f"Ошибка при удалении предыдущих сообщений помощи: {e}")
-    
-    await safe_delete_message(callback.message)
-    help_msg = await callback.message.answer(get_text("HELP_HOW_TO_ORDER"), reply_markup=help_menu())
-    await state.update_data(help_message_id=help_msg.message_id)
+    await show_help_section(callback.message, state, get_text("HELP_HOW_TO_ORDER"))
     await callback.answer()
 
 @router.callback_query(F.data == "help_payment")#Раздел помоши (Оплата)
 async def show_payment_info(callback: CallbackQuery, state: FSMContext):
-    try:
-        # Удаляем предыдущие сообщения помощи
-        await delete_previous_callback_messages(callback, state, "help")
-    except Exception as e:
-        user_log.error(f"Ошибка при удалении предыдущих сообщений помощи: {e}")
-    
-    await safe_delete_message(callback.message)
-    help_msg = await callback.message.answer(get_text("HELP_PAYMENT"), reply_markup=help_menu())
-    await state.update_data(help_message_id=help_msg.message_id)
+    await show_help_section(callback.message, state, get_text("HELP_PAYMENT"))
     await callback.answer()
 
 @router.callback_query(F.data == "help_delivery")#Раздел помоши (Доставка)
 async def show_delivery_info(callback: CallbackQuery, state: FSMContext):
-    try:
-        # Удаляем предыдущие сообщения помощи
-        await delete_previous_callback_messages(callback, state, "help")
-    except Exception as e:
-        user_log.error(f"Ошибка при удалении предыдущих сообщений помощи: {e}")
-    
-    await safe_delete_message(callback.message)
-    help_msg = await callback.message.answer(get_text("HELP_DELIVERY"), reply_markup=help_menu())
-    await state.update_data(help_message_id=help_msg.message_id)
+    await show_help_section(callback.message, state, get_text("HELP_DELIVERY"))
     await callback.answer()
 
 @router.callback_query(F.data == "help_contact")
 async def show_contact_help(callback: CallbackQuery, state: FSMContext):
-    try:
-        await delete_previous_callback_messages(callback, state, "help")
-    except Exception as e:
-        user_log.error(f"Произошла ошибка при удалении придыдуших сообшений: {e}")
-    
-    await safe_delete_message(callback.message)
-    help_msg = await callback.message.answer(get_text("HELP_CONTACT"), reply_markup=help_menu())
-    await state.update_data(help_message_id=help_msg.message_id)
+    await show_help_section(callback.message, state, get_text("HELP_CONTACT"))
     await callback.answer()
 
 
@@ -1042,8 +960,9 @@ async def delete_product_cards(callback: CallbackQuery, state: FSMContext):
         product_message_ids = data.get('product_message_ids', [])
         
         if product_message_ids:
-            for message_id in product_message_ids:
-                await safe_delete_message(callback.message.bot, callback.message.chat.id, message_id)
+            await safe_delete_messages(
+                callback.message.bot, callback.message.chat.id, product_message_ids, background=True
+            )
             
             # Очищаем список ID карточек товаров
             await state.update_data(product_message_ids=[])
@@ -1051,23 +970,10 @@ async def delete_product_cards(callback: CallbackQuery, state: FSMContext):
         user_log.error(f"Ошибка в delete_product_cards: {e}")
 
 @router.callback_query(F.data == "cancel_clear_cart")
-async def cancel_clear_cart(callback: CallbackQuery, state: FSMContext):
+async def cancel_clear_cart(callback: CallbackQuery, state: FSMContext, session: UserSession):
     try:
-        # Удаляем предыдущие сообщения корзины
-        await delete_previous_callback_messages(callback, state, "cart")
-        
-        user = await db.get_user(callback.from_user.id)
-        if not user or not user.get('cart'):
-            await callback.message.edit_text(
-                CART_EMPTY,
-                reply_markup=main_menu()
-            )
-        else:
-            total = sum(item['price'] * item['quantity'] for item in user['cart'])
-            await callback.message.edit_text(
-                f"💵 Итого: {format_price(total)} ₸",
-                reply_markup=cart_actions_kb()
-            )
+        user = await session.get()
+        await show_cart_message(callback.message, user, state, edit=True)
         await callback.answer(CLEAR_CART_CANCELLED)
         
     except Exception as e:
@@ -1088,90 +994,103 @@ async def check_cart_expiration(user: dict) -> bool:
 async def clear_expired_cart(user_id: int) -> bool:
     """Очищает истекшую корзину пользователя и возвращает товары в наличие"""
     try:
-        user = await db.get_user(user_id)
-        if not user or not user.get('cart'):
+        now = datetime.now()
+        # Атомарно забираем корзину, чтобы планировщик не вернул товары повторно
+        cart = await db.take_expired_cart(user_id, now)
+        if not cart:
             return False
-            
-        if await check_cart_expiration(user):
-            # Возвращаем товары в наличие
-            for item in user['cart']:
-                if 'flavor' in item:
-                    await db.update_product_flavor_quantity(
-                        item['product_id'],
-                        item['flavor'],
-                        item['quantity']
-                    )
-            
-            # Очищаем корзину
-            await db.update_user(user_id, {
-                'cart': [],
-                'cart_expires_at': None
-            })
-            
-            user_log.info(f"Expired cart cleared for user {user_id}")
-            return True
-        return False
+
+        # Возвращаем товары в наличие одной пакетной операцией
+        await db.release_items(cart)
+        await db.delete_cart_reservations([user_id], now)
+
+        user_log.info(f"Expired cart cleared for user {user_id}")
+        return True
     except Exception as e:
         user_log.error(f"Error clearing expired cart for user {user_id}: {e}")
         return False
 
-async def notify_cart_expiration(bot, user_id: int):
-    """Уведомляет пользователя об истечении корзины"""
-    try:
-        await bot.send_message(
-            chat_id=user_id,
-            text=CART_EXPIRATION_NOTIFICATION
-        )
-    except Exception as e:
-        user_log.error(f"Error notifying user {user_id} about cart expiration: {e}")
+async def notify_cart_expiration(user_id: int, expired_at: datetime):
+    """Ставит в очередь уведомление пользователя об истечении корзины"""
+    await queue_notification(
+        f"cart_expired:{user_id}:{expired_at.isoformat()}",
+        bot_call('send_message', chat_id=user_id, text=CART_EXPIRATION_NOTIFICATION)
+    )
 
-async def cleanup_expired_carts(bot=None):
-    """Очищает все истекшие корзины"""
+async def cleanup_expired_carts():
+    """Очищает все истекшие корзины по индексированным резервациям"""
     try:
-        # Получаем всех пользователей с корзинами
-        users = await db.get_users_with_cart()
-        
-        cleared_count = 0
-        for user in users:
-            if await clear_expired_cart(user['user_id']):
-                cleared_count += 1
-                # Уведомляем пользователя если bot доступен
-                if bot:
-                    await notify_cart_expiration(bot, user['user_id'])
-        
-        if cleared_count > 0:
-            user_log.info(f"Cleared {cleared_count} expired carts")
-            
+        now = datetime.now()
+        # Выбираем только просроченные резервации, а не всех пользователей с корзиной
+        user_ids = await db.get_due_cart_reservations(now)
+        if not user_ids:
+            return
+
+        released_items = []
+        cleared_users = []
+        for user_id in user_ids:
+            cart = await db.take_expired_cart(user_id, now)
+            if cart:
+                released_items.extend(cart)
+                cleared_users.append(user_id)
+
+        # Возвращаем товары всех истекших корзин одной пакетной операцией
+        if released_items:
+            await db.release_items(released_items)
+        await db.delete_cart_reservations(user_ids, now)
+
+        # Уведомления ставятся в outbox и доставляются без bot
+        for user_id in cleared_users:
+            await notify_cart_expiration(user_id, now)
+
+        if cleared_users:
+            user_log.info(f"Cleared {len(cleared_users)} expired carts")
+
     except Exception as e:
         user_log.error(f"Error in cleanup_expired_carts: {e}")
 
-async def start_cart_cleanup(bot=None):
-    """Запускает периодическую очистку истекших корзин"""
+async def next_cart_cleanup_delay() -> float:
+    """Время до ближайшего истечения корзины (в пределах интервала проверки)"""
+    next_expiry = await db.get_next_cart_expiry()
+    if next_expiry is None:
+        return CART_CLEANUP_INTERVAL
+    delay = (next_expiry - datetime.now()).total_seconds()
+    return min(max(delay, CART_CLEANUP_MIN_DELAY), CART_CLEANUP_INTERVAL)
+
+async def start_cart_cleanup():
+    """Запускает очистку истекших корзин по ближайшему сроку резервации"""
+    delay = CART_CLEANUP_INTERVAL
+    backfilled = False
     while True:
-        await asyncio.sleep(60)  # Проверяем каждую минуту
-        await cleanup_expired_carts(bot)
+        await asyncio.sleep(delay)
+        if not backfilled:
+            backfilled = await db.backfill_cart_reservations()
+        await cleanup_expired_carts()
+        delay = await next_cart_cleanup_delay()
 
 @router.callback_query(F.data == "main_menu")
 async def show_main_menu(callback: CallbackQuery, state: FSMContext):
     try:
-        # Удаляем предыдущие сообщения
-        await delete_previous_callback_messages(callback, state, "cart")
-        await delete_previous_callback_messages(callback, state, "catalog")
-        await delete_previous_callback_messages(callback, state, "help")
-        
-        # Удаляем карточки товаров
-        await delete_product_cards(callback, state)
-        
-        await safe_delete_message(callback.message)
+        # Удаляем остальные экраны и карточки товаров в фоне
+        data = await state.get_data()
+        await safe_delete_messages(callback.bot, callback.message.chat.id, [
+            message_id
+            for message_id in (
+                data.get('cart_message_id'),
+                data.get('catalog_message_id'),
+                data.get('help_message_id'),
+                *data.get('product_message_ids', [])
+            )
+            if message_id != callback.message.message_id
+        ], background=True)
         
-        # Отправляем приветственное сообщение с основными кнопками
-        welcome_msg = await callback.bot.send_message(
-            chat_id=callback.message.chat.id,
-            text=MAIN_MENU_WELCOME,
-            reply_markup=main_menu()
+        # Приветствие на месте нажатой кнопки; reply-клавиатура главного меню остаётся с /start
+        welcome_message_id = await render_panel(
+            callback.bot, callback.message.chat.id, state, MAIN_MENU_WELCOME,
+            edit_message_id=callback.message.message_id
         )
         
-        await state.update_data(welcome_message_id=welcome_msg.message_id)
+        await state.update_data(welcome_message_id=welcome_message_id, product_message_ids=[])
         await callback.answer(MAIN_MENU_SUCCESS)
         
     except Exception as e:
@@ -63,6 +63,57 @@ def order_management_kb(order_id: str, status: str = "pending") -> InlineKeyboar
     
     return InlineKeyboardMarkup(inline_keyboard=keyboard)
 
+# Фильтры панели заказов: код в callback_data -> статус / период (в днях, 0 — сегодня)
+ORDER_STATUS_FILTERS = {
+    "a": ("Все", None),
+    "p": ("⏳", "pending"),
+    "c": ("✅", "confirmed"),
+    "d": ("🏁", "completed"),
+    "x": ("❌", "cancelled"),
+}
+ORDER_PERIOD_FILTERS = {
+    "a": ("Всё время", None),
+    "t": ("Сегодня", 0),
+    "w": ("7 дней", 7),
+    "m": ("30 дней", 30),
+}
+
+def orders_dashboard_kb(order_id: str = None, status: str = "pending", status_filter: str = "a",
+                        period_filter: str = "a", cursor: str = None,
+                        has_newer: bool = False, has_older: bool = False) -> InlineKeyboardMarkup:
+    """Клавиатура панели заказов: действия с заказом, листание и фильтры"""
+    keyboard = []
+
+    if order_id:
+        keyboard.extend(order_management_kb(order_id, status).inline_keyboard)
+
+    filters = f"{status_filter}_{period_filter}"
+    nav_row = []
+    if has_newer:
+        nav_row.append(InlineKeyboardButton(text="⬅️ Новее", callback_data=f"orders_page_{filters}_p_{cursor}"))
+    if has_older:
+        nav_row.append(InlineKeyboardButton(text="Старее ➡️", callback_data=f"orders_page_{filters}_n_{cursor}"))
+    if nav_row:
+        keyboard.append(nav_row)
+
+    keyboard.append([
+        InlineKeyboardButton(
+            text=f"• {label}" if code == status_filter else label,
+            callback_data=f"orders_view_{code}_{period_filter}"
+        )
+        for code, (label, _) in ORDER_STATUS_FILTERS.items()
+    ])
+    keyboard.append([
+        InlineKeyboardButton(
+            text=f"• {label}" if code == period_filter else label,
+            callback_data=f"orders_view_{status_filter}_{code}"
+        )
+        for code, (label, _) in ORDER_PERIOD_FILTERS.items()
+    ])
+    keyboard.append([InlineKeyboardButton(text="🗑 Очистить заказы", callback_data="delete_all_orders")])
+
+    return InlineKeyboardMarkup(inline_keyboard=keyboard)
+
 def confirm_action_kb(action: str, item_id: str) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=[
         [
@@ -55,6 +55,20 @@ def product_actions_kb(product_id: str, in_cart: bool = False, flavors: list = N
 
     return InlineKeyboardMarkup(inline_keyboard=buttons)
 
+# 🔹 Карточка товара с листанием страниц каталога
+def catalog_page_kb(product_id: str, flavors: list, page: int, total: int) -> InlineKeyboardMarkup:
+    rows = product_actions_kb(product_id, False, flavors).inline_keyboard
+
+    nav = []
+    if page > 0:
+        nav.append(InlineKeyboardButton(text="⬅️", callback_data=f"catalog_page_{page - 1}"))
+    nav.append(InlineKeyboardButton(text=f"{page + 1}/{total}", callback_data="noop"))
+    if page < total - 1:
+        nav.append(InlineKeyboardButton(text="➡️", callback_data=f"catalog_page_{page + 1}"))
+
+    # Навигация — над кнопками «Назад» и «Главное меню»
+    return InlineKeyboardMarkup(inline_keyboard=[*rows[:-1], nav, rows[-1]])
+
 # 🔹 Кнопки действий в корзине
 def cart_actions_kb() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=[
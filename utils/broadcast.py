@@ -0,0 +1,227 @@
+import asyncio
+import logging
+import time
+from datetime import datetime
+from typing import Dict, Optional
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+
+from database import db
+
+broadcast_log = logging.getLogger(__name__)
+
+# Лимит Telegram: ~30 сообщений в секунду суммарно (каждый пользователь получает одно сообщение,
+# поэтому ограничение на чат не достигается)
+GLOBAL_RATE = 25  # Сообщений в секунду (с запасом от лимита 30)
+MAX_CONCURRENCY = 10  # Одновременных запросов к Bot API
+CHECKPOINT_SIZE = 100  # Пользователей между сохранениями прогресса
+PROGRESS_INTERVAL = 5  # Интервал обновления сообщения с прогрессом (в секундах)
+MAX_SEND_ATTEMPTS = 3  # Попыток отправки одному пользователю
+
+# Ответы Forbidden, после которых пользователя можно удалить: бот заблокирован или аккаунт удалён
+UNREACHABLE_ERRORS = ("bot was blocked by the user", "user is deactivated")
+
+
+class TokenBucket:
+    """Token bucket на монотонных часах с поддержкой глобальной паузы (RetryAfter)"""
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float):
+        """Приостанавливает выдачу токенов (например, после RetryAfter)"""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class BroadcastManager:
+    """
+    Рассылка с ограничением скорости и сохранением прогресса в MongoDB.
+    Пользователи читаются потоком по возрастанию user_id; после каждой пачки
+    сохраняется последний обработанный user_id, поэтому после перезапуска
+    рассылка продолжается с места остановки (повторно может уйти максимум одна пачка).
+    """
+
+    def __init__(self):
+        self._tasks: Dict[str, asyncio.Task] = {}
+        self._limiter = TokenBucket(GLOBAL_RATE)
+
+    async def start(self, bot: Bot, text: str, chat_id: int, message_id: int) -> Optional[str]:
+        """Создаёт запись о рассылке и запускает её в фоне"""
+        broadcast_id = await db.create_broadcast({
+            'text': text,
+            'status': 'running',
+            'chat_id': chat_id,
+            'message_id': message_id,
+            'last_user_id': None,
+            'sent': 0,
+            'failed': 0,
+            'created_at': datetime.now(),
+            'updated_at': datetime.now()
+        })
+        if not broadcast_id:
+            return None
+
+        self._spawn(bot, broadcast_id)
+        return broadcast_id
+
+    async def resume(self, bot: Bot):
+        """Продолжает рассылки, прерванные перезапуском"""
+        for broadcast in await db.get_running_broadcasts():
+            broadcast_log.info(f"Продолжение рассылки {broadcast['_id']} после user_id={broadcast.get('last_user_id')}")
+            self._spawn(bot, broadcast['_id'])
+
+    async def stop(self):
+        """Останавливает фоновые рассылки (прогресс остаётся в базе)"""
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._tasks.clear()
+
+    def _spawn(self, bot: Bot, broadcast_id: str):
+        if broadcast_id in self._tasks and not self._tasks[broadcast_id].done():
+            return
+        task = asyncio.create_task(self._run(bot, broadcast_id))
+        self._tasks[broadcast_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(broadcast_id, None))
+
+    async def _run(self, bot: Bot, broadcast_id: str):
+        broadcast = await db.get_broadcast(broadcast_id)
+        if not broadcast:
+            return
+
+        text = broadcast['text']
+        stats = {'sent': broadcast.get('sent', 0), 'failed': broadcast.get('failed', 0)}
+        last_user_id = broadcast.get('last_user_id')
+        semaphore = asyncio.Semaphore(MAX_CONCURRENCY)
+        last_progress = 0.0
+
+        try:
+            batch = []
+            async for user_id in db.iter_user_ids(after_user_id=last_user_id, batch_size=CHECKPOINT_SIZE):
+                batch.append(user_id)
+                if len(batch) < CHECKPOINT_SIZE:
+                    continue
+
+                await self._send_batch(bot, batch, text, stats, semaphore)
+                last_user_id = batch[-1]
+                batch = []
+                await self._checkpoint(broadcast_id, last_user_id, stats)
+
+                if time.monotonic() - last_progress >= PROGRESS_INTERVAL:
+                    last_progress = time.monotonic()
+                    await self._report(bot, broadcast, stats)
+
+            if batch:
+                await self._send_batch(bot, batch, text, stats, semaphore)
+                last_user_id = batch[-1]
+
+            await self._checkpoint(broadcast_id, last_user_id, stats, status='done')
+            await self._report(bot, broadcast, stats, finished=True)
+            broadcast_log.info(
+                f"Рассылка завершена: отправлено {stats['sent']}, не доставлено {stats['failed']}"
+            )
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            broadcast_log.exception(f"Ошибка рассылки {broadcast_id}: {e}")
+
+    async def _send_batch(self, bot: Bot, user_ids: list, text: str, stats: dict, semaphore: asyncio.Semaphore):
+        results = await asyncio.gather(*(self._send_one(bot, user_id, text, semaphore) for user_id in user_ids))
+
+        unreachable = []
+        for user_id, result in zip(user_ids, results):
+            if result == 'sent':
+                stats['sent'] += 1
+            else:
+                stats['failed'] += 1
+                if result == 'unreachable':
+                    unreachable.append(user_id)
+
+        # Удаляем недоступных пользователей, если их корзина пуста
+        if unreachable:
+            try:
+                deleted_count = await db.delete_users_bulk(unreachable, only_empty_cart=True)
+                broadcast_log.info(f"Массово удалено пользователей: {deleted_count}")
+            except Exception as e:
+                broadcast_log.error(f"Ошибка при массовом удалении пользователей: {e}")
+
+    async def _send_one(self, bot: Bot, user_id: int, text: str, semaphore: asyncio.Semaphore) -> str:
+        async with semaphore:
+            for _ in range(MAX_SEND_ATTEMPTS):
+                await self._limiter.acquire()
+                try:
+                    await bot.send_message(chat_id=user_id, text=text)
+                    return 'sent'
+                except TelegramRetryAfter as e:
+                    broadcast_log.warning(f"Flood control, пауза {e.retry_after} с")
+                    self._limiter.pause(e.retry_after)
+                except TelegramForbiddenError as e:
+                    broadcast_log.error(f"Не удалось отправить сообщение пользователю {user_id}: {e}")
+                    message = str(e).lower()
+                    return 'unreachable' if any(error in message for error in UNREACHABLE_ERRORS) else 'failed'
+                except Exception as e:
+                    broadcast_log.error(f"Не удалось отправить сообщение пользователю {user_id}: {e}")
+                    return 'failed'
+            return 'failed'
+
+    async def _checkpoint(self, broadcast_id: str, last_user_id, stats: dict, status: str = 'running'):
+        await db.update_broadcast(broadcast_id, {
+            'last_user_id': last_user_id,
+            'sent': stats['sent'],
+            'failed': stats['failed'],
+            'status': status,
+            'updated_at': datetime.now()
+        })
+
+    async def _report(self, bot: Bot, broadcast: dict, stats: dict, finished: bool = False):
+        """Обновляет одно сообщение администратора с прогрессом рассылки"""
+        if finished:
+            text = (
+                f"✅ Рассылка завершена!\n\n"
+                f"📨 Отправлено: {stats['sent']}\n"
+                f"{'❌ Не доставлено: ' + str(stats['failed']) if stats['failed'] else ''}"
+            )
+        else:
+            text = (
+                f"📢 Рассылка выполняется...\n\n"
+                f"📨 Отправлено: {stats['sent']}\n"
+                f"❌ Не доставлено: {stats['failed']}"
+            )
+
+        try:
+            await bot.edit_message_text(
+                text=text,
+                chat_id=broadcast['chat_id'],
+                message_id=broadcast['message_id']
+            )
+        except TelegramBadRequest as e:
+            if "message is not modified" not in str(e):
+                broadcast_log.warning(f"Не удалось обновить прогресс рассылки: {e}")
+        except Exception as e:
+            broadcast_log.warning(f"Не удалось обновить прогресс рассылки: {e}")
+
+
+# Глобальный экземпляр менеджера рассылок
+broadcast_manager = BroadcastManager()
@@ -1,6 +1,19 @@
+import asyncio
+import logging
+from typing import Iterable, List
+
+from aiogram import Bot
 from aiogram.exceptions import TelegramBadRequest
 from aiogram.types import Message
 
+message_log = logging.getLogger(__name__)
+
+DELETE_MESSAGES_CHUNK = 100  # Максимум сообщений в одном вызове deleteMessages
+DELETE_CONCURRENCY = 10  # Одновременных deleteMessage, если пакетное удаление недоступно
+
+# Фоновые удаления: ссылки держим, чтобы задачи не собрал сборщик мусора
+_background_deletes = set()
+
 async def safe_delete_message(message_or_bot, chat_id=None, message_id=None):
     """
     Удаляет сообщение безопасно.
@@ -18,4 +31,44 @@ async def safe_delete_message(message_or_bot, chat_id=None, message_id=None):
         else:
             raise
     except Exception:
-        pass 
\ No newline at end of file
+        pass
+
+async def _delete_one_by_one(bot: Bot, chat_id, message_ids: List[int]):
+    semaphore = asyncio.Semaphore(DELETE_CONCURRENCY)
+
+    async def delete(message_id):
+        async with semaphore:
+            try:
+                await safe_delete_message(bot, chat_id, message_id)
+            except Exception as e:
+                message_log.warning(f"Не удалось удалить сообщение {message_id}: {e}")
+
+    await asyncio.gather(*(delete(message_id) for message_id in message_ids))
+
+async def _delete_messages(bot: Bot, chat_id, message_ids: List[int]):
+    for start in range(0, len(message_ids), DELETE_MESSAGES_CHUNK):
+        chunk = message_ids[start:start + DELETE_MESSAGES_CHUNK]
+        try:
+            # Несуществующие и недоступные сообщения deleteMessages пропускает сам
+            await bot.delete_messages(chat_id=chat_id, message_ids=chunk)
+        except Exception as e:
+            message_log.debug(f"deleteMessages недоступен, удаляем по одному: {e}")
+            await _delete_one_by_one(bot, chat_id, chunk)
+
+async def safe_delete_messages(bot: Bot, chat_id, message_ids: Iterable, background: bool = False):
+    """
+    Удаляет несколько сообщений чата пакетами по 100 (deleteMessages),
+    при ошибке — параллельно по одному с ограничением DELETE_CONCURRENCY.
+    Пустые и повторяющиеся id пропускаются. background=True не ждёт удаления,
+    чтобы следующий экран появился сразу.
+    """
+    ids = list(dict.fromkeys(message_id for message_id in message_ids if message_id))
+    if not ids:
+        return
+    if not background:
+        await _delete_messages(bot, chat_id, ids)
+        return
+
+    task = asyncio.create_task(_delete_messages(bot, chat_id, ids))
+    _background_deletes.add(task)
+    task.add_done_callback(_background_deletes.discard)
@@ -0,0 +1,184 @@
+import asyncio
+import logging
+import random
+from datetime import datetime, timedelta
+from typing import List, Optional
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+from aiogram.types import InlineKeyboardMarkup
+
+from database import db
+
+outbox_log = logging.getLogger(__name__)
+
+WORKER_COUNT = 4  # Одновременно доставляемых записей
+POLL_INTERVAL = 30  # Проверка очереди без сигналов о новых записях (в секундах)
+LEASE_SECONDS = 120  # Время, на которое запись закрепляется за обработчиком (продлевается на каждом шаге)
+SEND_TIMEOUT = 60  # Предел одного вызова Bot API (в секундах), меньше LEASE_SECONDS
+RETRY_BASE_DELAY = 5  # Первая пауза перед повторной отправкой (в секундах), далее удваивается
+RETRY_MAX_DELAY = 600  # Максимальная пауза между попытками (в секундах)
+MAX_ATTEMPTS = 8  # Попыток доставки одной записи
+
+# Методы Bot API, которые можно поставить в очередь
+ALLOWED_METHODS = ("send_message", "send_photo", "send_document")
+
+
+def bot_call(method: str, **params) -> dict:
+    """Описание вызова Bot API для записи в outbox"""
+    if method not in ALLOWED_METHODS:
+        raise ValueError(f"Unsupported outbox method: {method}")
+    reply_markup = params.get("reply_markup")
+    if isinstance(reply_markup, InlineKeyboardMarkup):
+        params["reply_markup"] = reply_markup.model_dump(exclude_none=True)
+    return {"method": method, "params": params}
+
+
+async def queue_notification(key: str, *calls: dict) -> bool:
+    """
+    Ставит уведомление в очередь вместо отправки в обработчике.
+    key — ключ дедупликации: повторная постановка с тем же ключом ничего не добавит.
+    """
+    try:
+        await db.enqueue_outbox(key, list(calls))
+        return True
+    except Exception as e:
+        outbox_log.error(f"Не удалось поставить уведомление {key} в очередь: {e}")
+        return False
+
+
+def retry_delay(attempts: int) -> float:
+    """Экспоненциальная пауза с разбросом, чтобы повторы не приходили пачкой"""
+    delay = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** max(0, attempts - 1))
+    return delay * random.uniform(0.8, 1.2)
+
+
+class OutboxWorker:
+    """
+    Доставка уведомлений из коллекции outbox пулом из WORKER_COUNT обработчиков.
+    Запись ставится в очередь вместе с бизнес-изменением, а отправка идёт в фоне,
+    поэтому пользователь получает ответ сразу. Вызовы одной записи выполняются по порядку;
+    номер выполненного шага сохраняется, так что после сбоя уже отправленное не дублируется.
+    Запись закрепляется за обработчиком на LEASE_SECONDS и продлевается перед каждым шагом,
+    а один вызов ограничен SEND_TIMEOUT, поэтому аренда не истекает посреди отправки
+    и несколько экземпляров бота могут разбирать одну очередь.
+    """
+
+    def __init__(self, workers: int = WORKER_COUNT):
+        self._bot: Optional[Bot] = None
+        self._workers = workers
+        self._tasks: List[asyncio.Task] = []
+        self._wakeup = asyncio.Event()
+
+    def notify(self, collection: str = None, key=None):
+        """Write listener базы: будит обработчик при появлении новой записи"""
+        if collection == "outbox":
+            self._wakeup.set()
+
+    async def start(self, bot: Bot):
+        self._bot = bot
+        db.add_write_listener(self.notify)
+        self._tasks = [task for task in self._tasks if not task.done()]
+        while len(self._tasks) < self._workers:
+            self._tasks.append(asyncio.create_task(self._run()))
+        outbox_log.info(f"Outbox worker pool started ({self._workers} workers)")
+
+    async def stop(self):
+        db.remove_write_listener(self.notify)
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _run(self):
+        while True:
+            try:
+                record = await db.claim_outbox(datetime.now(), LEASE_SECONDS)
+                if record is not None:
+                    await self._deliver(record)
+                    continue
+
+                if self._wakeup.is_set():
+                    # Сигнал уже разобран другими обработчиками
+                    self._wakeup.clear()
+                    continue
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=await self._idle_timeout())
+                except asyncio.TimeoutError:
+                    pass
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                outbox_log.exception(f"Ошибка обработчика outbox: {e}")
+                await asyncio.sleep(RETRY_BASE_DELAY)
+
+    async def _idle_timeout(self) -> float:
+        next_attempt = await db.get_next_outbox_attempt()
+        if next_attempt is None:
+            return POLL_INTERVAL
+        return min(POLL_INTERVAL, max(0.0, (next_attempt - datetime.now()).total_seconds()))
+
+    async def _deliver(self, record: dict):
+        key = record["_id"]
+        calls = record.get("calls", [])
+        step = record.get("step", 0)
+        attempts = record.get("attempts", 0)
+
+        try:
+            while step < len(calls):
+                await asyncio.wait_for(self._execute(calls[step]), timeout=SEND_TIMEOUT)
+                step += 1
+                # Вместе с шагом продлеваем аренду на следующий вызов
+                await db.update_outbox(key, {"step": step, "locked_until": self._lease_deadline()})
+        except TelegramRetryAfter as e:
+            await self._retry(key, step, e.retry_after, str(e))
+            return
+        except (TelegramForbiddenError, TelegramBadRequest, ValueError) as e:
+            # Повтор не поможет: чат недоступен или запрос некорректен
+            outbox_log.error(f"Уведомление {key} не доставлено: {e}")
+            await self._finish(key, "failed", step, str(e))
+            return
+        except Exception as e:
+            error = str(e) or type(e).__name__  # у таймаута SEND_TIMEOUT пустой текст
+            if attempts >= MAX_ATTEMPTS:
+                outbox_log.error(f"Уведомление {key} не доставлено после {MAX_ATTEMPTS} попыток: {error}")
+                await self._finish(key, "failed", step, error)
+            else:
+                await self._retry(key, step, retry_delay(attempts), error)
+            return
+
+        await self._finish(key, "sent", step)
+
+    @staticmethod
+    def _lease_deadline() -> datetime:
+        return datetime.now() + timedelta(seconds=LEASE_SECONDS)
+
+    async def _finish(self, key: str, status: str, step: int, error: str = None):
+        # finished_at включает удаление записи по TTL-индексу
+        update = {"status": status, "step": step, "finished_at": datetime.now(), "locked_until": None}
+        if error:
+            update["last_error"] = error
+        await db.update_outbox(key, update)
+
+    async def _retry(self, key: str, step: int, delay: float, error: str):
+        outbox_log.warning(f"Повторная отправка уведомления {key} через {delay:.0f} с: {error}")
+        await db.update_outbox(key, {
+            "status": "pending",
+            "step": step,
+            "next_attempt_at": datetime.now() + timedelta(seconds=delay),
+            "locked_until": None,
+            "last_error": error
+        })
+
+    async def _execute(self, call: dict):
+        method = call["method"]
+        if method not in ALLOWED_METHODS:
+            raise ValueError(f"Unsupported outbox method: {method}")
+        params = dict(call.get("params", {}))
+        if params.get("reply_markup"):
+            params["reply_markup"] = InlineKeyboardMarkup.model_validate(params["reply_markup"])
+        await getattr(self._bot, method)(**params)
+
+
+# Глобальный пул обработчиков outbox
+outbox_worker = OutboxWorker()
@@ -0,0 +1,59 @@
+import logging
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.fsm.context import FSMContext
+from aiogram.types import InlineKeyboardMarkup
+
+from utils.message_utils import safe_delete_messages
+
+panel_log = logging.getLogger(__name__)
+
+PANEL_STATE_KEY = "panel_message_id"  # Ключ активной панели в FSM-данных чата
+
+
+async def render_panel(
+    bot: Bot,
+    chat_id,
+    state: FSMContext,
+    text: str,
+    reply_markup: InlineKeyboardMarkup = None,
+    edit_message_id: int = None,
+    parse_mode: str = None
+) -> int:
+    """
+    Показывает экран в активной панели чата — единственном сообщении навигации.
+    edit_message_id — сообщение, на кнопку которого нажали: оно редактируется на месте
+    (edit_message_text). Без него (переход с reply-клавиатуры) или если редактирование
+    невозможно (сообщение удалено, это карточка товара с фото, нужна reply-клавиатура)
+    отправляется новое сообщение.
+    Предыдущая панель удаляется в фоне. Возвращает ID сообщения панели.
+    """
+    data = await state.get_data()
+    previous_panel_id = data.get(PANEL_STATE_KEY)
+    panel_id = None
+
+    if edit_message_id and (reply_markup is None or isinstance(reply_markup, InlineKeyboardMarkup)):
+        try:
+            await bot.edit_message_text(
+                text,
+                chat_id=chat_id,
+                message_id=edit_message_id,
+                reply_markup=reply_markup,
+                parse_mode=parse_mode
+            )
+            panel_id = edit_message_id
+        except TelegramBadRequest as e:
+            if "message is not modified" in str(e):
+                panel_id = edit_message_id
+            else:
+                panel_log.debug(f"Сообщение {edit_message_id} не редактируется, отправляем новое: {e}")
+
+    if panel_id is None:
+        msg = await bot.send_message(chat_id, text, reply_markup=reply_markup, parse_mode=parse_mode)
+        panel_id = msg.message_id
+
+    stale = [message_id for message_id in (previous_panel_id, edit_message_id) if message_id != panel_id]
+    await safe_delete_messages(bot, chat_id, stale, background=True)
+    await state.update_data({PANEL_STATE_KEY: panel_id})
+    return panel_id
@@ -0,0 +1,107 @@
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware
+from aiogram.dispatcher.flags import get_flag
+from aiogram.types import CallbackQuery, TelegramObject
+
+from database import db
+from texts import RATE_LIMIT_WARNING
+
+rate_log = logging.getLogger(__name__)
+
+RATE_LIMIT_SECONDS = 1  # Минимальный интервал между нажатиями одной кнопки (в секундах)
+RATE_LIMIT_MAX_KEYS = 100_000  # Максимум отслеживаемых пар (пользователь, кнопка) в памяти
+
+
+class MemoryRateLimiter:
+    """
+    Token bucket на монотонных часах для каждого ключа.
+    Ключи хранятся в OrderedDict в порядке последнего обращения: корзина, простоявшая
+    дольше capacity / rate, снова полная и ничем не отличается от отсутствующей,
+    поэтому такие записи снимаются с головы списка при каждом обращении (амортизированно O(1)).
+    Размер ограничен max_keys — при переполнении вытесняются самые давние ключи.
+    """
+
+    def __init__(self, rate: float, capacity: float = 1, max_keys: int = RATE_LIMIT_MAX_KEYS):
+        self.rate = rate
+        self.capacity = capacity
+        self._max_keys = max_keys
+        self._idle_ttl = capacity / rate
+        self._buckets: "OrderedDict[str, tuple]" = OrderedDict()  # {key: (tokens, updated)}
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+    def _expire(self, now: float):
+        while self._buckets:
+            _, (_, updated) = next(iter(self._buckets.items()))
+            if now - updated < self._idle_ttl and len(self._buckets) < self._max_keys:
+                break
+            self._buckets.popitem(last=False)
+
+    async def allow(self, key: str) -> bool:
+        now = time.monotonic()
+        tokens, updated = self._buckets.pop(key, (self.capacity, now))
+        self._expire(now)
+
+        tokens = min(self.capacity, tokens + (now - updated) * self.rate)
+        allowed = tokens >= 1
+        if allowed:
+            tokens -= 1
+        self._buckets[key] = (tokens, now)
+        return allowed
+
+
+class MongoRateLimiter:
+    """
+    Token bucket в MongoDB (коллекция rate_limits): лимит общий для всех экземпляров бота.
+    Пополнение и списание выполняются одним атомарным обновлением по часам сервера.
+    При недоступности базы нажатие пропускается, чтобы бот не блокировал пользователей.
+    """
+
+    def __init__(self, rate: float, capacity: float = 1):
+        self.rate = rate
+        self.capacity = capacity
+
+    async def allow(self, key: str) -> bool:
+        allowed = await db.take_rate_limit_token(key, self.rate, self.capacity)
+        return True if allowed is None else allowed
+
+
+def create_rate_limiter(backend: str = "memory"):
+    """Создаёт ограничитель для backend "memory" (по умолчанию) или "mongo" """
+    rate = 1 / RATE_LIMIT_SECONDS
+    if backend == "mongo":
+        return MongoRateLimiter(rate)
+    if backend != "memory":
+        rate_log.warning(f"Неизвестный RATE_LIMIT_BACKEND '{backend}', используется memory")
+    return MemoryRateLimiter(rate)
+
+
+class RateLimitMiddleware(BaseMiddleware):
+    """
+    Ограничивает частоту нажатий для обработчиков с флагом rate_limit:
+    @router.callback_query(..., flags={"rate_limit": True})
+    Лимит считается отдельно для каждой пары (пользователь, callback_data).
+    """
+
+    def __init__(self, limiter):
+        self._limiter = limiter
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        if not isinstance(event, CallbackQuery) or not get_flag(data, "rate_limit"):
+            return await handler(event, data)
+
+        if not await self._limiter.allow(f"{event.from_user.id}:{event.data}"):
+            await event.answer(RATE_LIMIT_WARNING, show_alert=True)
+            return None
+
+        return await handler(event, data)
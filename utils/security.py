@@ -156,23 +156,21 @@ async def return_items_to_inventory(order_items):
     Returns True if successful, False if any item failed
     """
     try:
-        for item in order_items:
-            if 'flavor' in item:
-                security_log.info(f"Returning item to inventory: product_id={item['product_id']}, flavor={item['flavor']}, quantity={item['quantity']}")
-                
-                success = await db.update_product_flavor_quantity(
-                    item['product_id'],
-                    item['flavor'],
-                    item['quantity']  # Return the full quantity
-                )
-                
-                if not success:
-                    security_log.error(f"Failed to restore flavor quantity: product_id={item['product_id']}, flavor={item['flavor']}")
-                    return False
-                else:
-                    security_log.info(f"Successfully restored flavor quantity for {item['flavor']}")
-        
-        return True
+        items = [item for item in order_items if 'flavor' in item]
+        for item in items:
+            security_log.info(f"Returning item to inventory: product_id={item['product_id']}, flavor={item['flavor']}, quantity={item['quantity']}")
+
+        results = await db.release_items(items)
+
+        success = True
+        for result in results:
+            if not result['success']:
+                security_log.error(f"Failed to restore flavor quantity: product_id={result['product_id']}, flavor={result['flavor']}")
+                success = False
+            else:
+                security_log.info(f"Successfully restored flavor quantity for {result['flavor']}")
+
+        return success
     except Exception as e:
         security_log.error(f"Error returning items to inventory: {str(e)}")
-        return False 
\ No newline at end of file
+        return False
@@ -1,33 +1,144 @@
 from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton
+from pymongo.errors import OperationFailure
 from database import db
 from config import ADMIN_SWITCHING
+import asyncio
 import logging
 from datetime import datetime, timedelta
-from typing import Union
+from typing import Optional, Union
 
 sleep_log = logging.getLogger(__name__)
 
-async def check_sleep_mode(obj: Union[Message, CallbackQuery]) -> bool:
-    """Проверка режима сна. Возвращает True, если магазин спит и сообщение показано"""
+# Коллекции, изменения в которых влияют на режим сна
+WATCHED_COLLECTIONS = ("settings", "orders")
+WATCH_RETRY_DELAY = 5  # Пауза перед переподключением change stream (в секундах)
 
-    try:
-        # Проверка, нужно ли включить режим сна
-        approved_count = await db.count_approved_orders()
-        if approved_count >= ADMIN_SWITCHING:
-            sleep_data = await db.get_sleep_mode()
-            if not sleep_data or not sleep_data.get("enabled", False):
-                end_time = (datetime.now() + timedelta(hours=2)).strftime("%H:%M")
-                await db.set_sleep_mode(True, end_time)
-                sleep_data = {"enabled": True, "end_time": end_time}
 
-        # Проверка, активен ли режим сна
+class SleepModeState:
+    """
+    Кэш состояния режима сна и количества активных заказов.
+    Обновляется после записей этого процесса (через write listener базы)
+    и по событиям change stream, поэтому проверка на горячем пути не делает запросов к MongoDB.
+    """
+
+    def __init__(self):
+        self.enabled: bool = False
+        self.end_time: Optional[str] = None
+        self.active_orders: int = 0
+        self._loaded = False
+        self._dirty = False
+        self._refresh_task: Optional[asyncio.Task] = None
+        self._watch_task: Optional[asyncio.Task] = None
+
+    @property
+    def loaded(self) -> bool:
+        return self._loaded
+
+    async def refresh(self) -> bool:
+        """Перечитывает состояние режима сна и счётчик активных заказов из базы"""
         sleep_data = await db.get_sleep_mode()
+        active_orders = await db.count_approved_orders()
         if sleep_data is None:
             sleep_log.warning("Не удалось получить данные sleep_mode")
             return False
 
-        if sleep_data.get("enabled", False):
-            end_time = sleep_data.get("end_time", "Не указано")
+        self.enabled = bool(sleep_data.get("enabled", False))
+        self.end_time = sleep_data.get("end_time")
+        self.active_orders = active_orders
+        self._loaded = True
+        return True
+
+    def apply(self, enabled: bool, end_time: Optional[str]):
+        """Сразу применяет известное состояние без обращения к базе"""
+        self.enabled = enabled
+        self.end_time = end_time
+
+    def invalidate(self, collection: str = None, key=None):
+        """Помечает кэш устаревшим и планирует фоновое обновление"""
+        if collection is not None and collection not in WATCHED_COLLECTIONS:
+            return
+        self._dirty = True
+        if self._refresh_task is None or self._refresh_task.done():
+            try:
+                self._refresh_task = asyncio.get_running_loop().create_task(self._refresh_while_dirty())
+            except RuntimeError:
+                # Нет запущенного цикла событий — обновимся при следующей проверке
+                self._loaded = False
+
+    async def _refresh_while_dirty(self):
+        # Несколько записей подряд схлопываются в одно-два чтения
+        while self._dirty:
+            self._dirty = False
+            try:
+                await self.refresh()
+            except Exception as e:
+                sleep_log.error(f"Ошибка при обновлении кэша режима сна: {e}")
+
+    async def _watch(self):
+        """Следит за изменениями settings/orders через change stream"""
+        pipeline = [{"$match": {"ns.coll": {"$in": list(WATCHED_COLLECTIONS)}}}]
+        while True:
+            try:
+                await db.ensure_connected()
+                async with db.db.watch(pipeline) as stream:
+                    # Догоняем изменения, пропущенные до открытия потока
+                    self.invalidate()
+                    async for _ in stream:
+                        self.invalidate()
+            except asyncio.CancelledError:
+                raise
+            except OperationFailure as e:
+                # Standalone-сервер не поддерживает change streams
+                sleep_log.warning(
+                    f"Change streams недоступны, кэш режима сна обновляется только по локальным записям: {e}"
+                )
+                return
+            except Exception as e:
+                sleep_log.error(f"Ошибка change stream режима сна: {e}")
+                await asyncio.sleep(WATCH_RETRY_DELAY)
+
+    async def start(self):
+        """Загружает состояние и подписывается на изменения"""
+        db.add_write_listener(self.invalidate)
+        await self.refresh()
+        if self._watch_task is None or self._watch_task.done():
+            self._watch_task = asyncio.create_task(self._watch())
+        sleep_log.info("Sleep mode state cache started")
+
+    async def stop(self):
+        """Останавливает наблюдение за изменениями"""
+        db.remove_write_listener(self.invalidate)
+        for task in (self._watch_task, self._refresh_task):
+            if task and not task.done():
+                task.cancel()
+                try:
+                    await task
+                except (asyncio.CancelledError, Exception):
+                    pass
+        self._watch_task = None
+        self._refresh_task = None
+
+
+# Глобальный экземпляр кэша режима сна
+sleep_state = SleepModeState()
+
+
+async def check_sleep_mode(obj: Union[Message, CallbackQuery]) -> bool:
+    """Проверка режима сна. Возвращает True, если магазин спит и сообщение показано"""
+
+    try:
+        if not sleep_state.loaded and not await sleep_state.refresh():
+            return False
+
+        # Проверка, нужно ли включить режим сна
+        if sleep_state.active_orders >= ADMIN_SWITCHING and not sleep_state.enabled:
+            end_time = (datetime.now() + timedelta(hours=2)).strftime("%H:%M")
+            await db.set_sleep_mode(True, end_time)
+            sleep_state.apply(True, end_time)
+
+        # Проверка, активен ли режим сна
+        if sleep_state.enabled:
+            end_time = sleep_state.end_time or "Не указано"
             help_button = InlineKeyboardMarkup(inline_keyboard=[
                 [InlineKeyboardButton(text="ℹ️ Помощь", callback_data="show_help")]
             ])
@@ -0,0 +1,110 @@
+import asyncio
+import logging
+import time
+from contextlib import asynccontextmanager
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject, User
+
+lock_log = logging.getLogger(__name__)
+
+USER_LOCK_MAX_KEYS = 10_000  # Максимум отдельных блокировок одновременно
+USER_LOCK_STRIPES = 64  # Общие блокировки для ключей сверх лимита
+USER_LOCK_SLOW_WAIT = 5  # Ожидание дольше этого (в секундах) пишется в лог
+
+
+class KeyedLock:
+    """
+    Таблица блокировок по ключу с подсчётом ссылок: запись живёт, пока её кто-то держит
+    или ждёт, поэтому размер таблицы равен числу пользователей, обрабатываемых прямо сейчас.
+    Если таблица заполнена до max_keys, новые ключи делят одну из stripes общих блокировок —
+    обработка остаётся корректной, лишь часть пользователей ждёт друг друга.
+    """
+
+    def __init__(self, max_keys: int = USER_LOCK_MAX_KEYS, stripes: int = USER_LOCK_STRIPES):
+        self._max_keys = max_keys
+        self._locks: Dict[Hashable, list] = {}  # {key: [lock, holders]}
+        self._stripes: List[asyncio.Lock] = [asyncio.Lock() for _ in range(stripes)]
+        # Метрики ожидания
+        self.acquired = 0
+        self.contended = 0
+        self.striped = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def __len__(self) -> int:
+        return len(self._locks)
+
+    @asynccontextmanager
+    async def lock(self, key: Hashable):
+        entry = self._locks.get(key)
+        if entry is None and len(self._locks) >= self._max_keys:
+            self.striped += 1
+            async with self._timed(self._stripes[hash(key) % len(self._stripes)], key):
+                yield
+            return
+
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with self._timed(entry[0], key):
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                self._locks.pop(key, None)
+
+    @asynccontextmanager
+    async def _timed(self, lock: asyncio.Lock, key: Hashable):
+        if lock.locked():
+            self.contended += 1
+        started = time.monotonic()
+        async with lock:
+            waited = time.monotonic() - started
+            self.acquired += 1
+            self.total_wait += waited
+            self.max_wait = max(self.max_wait, waited)
+            if waited >= USER_LOCK_SLOW_WAIT:
+                lock_log.warning(f"Обновление {key} ждало предыдущее {waited:.1f} с")
+            yield
+
+    def stats(self) -> dict:
+        """Метрики ожидания с момента запуска"""
+        return {
+            "active_keys": len(self._locks),
+            "acquired": self.acquired,
+            "contended": self.contended,
+            "striped": self.striped,
+            "avg_wait": self.total_wait / self.acquired if self.acquired else 0.0,
+            "max_wait": self.max_wait,
+        }
+
+
+class UserLockMiddleware(BaseMiddleware):
+    """
+    Outer middleware для dp.update: обновления одного пользователя обрабатываются по очереди,
+    разные пользователи — параллельно. Двойное нажатие не может пройти между
+    проверкой корзины и резервированием товара в обработчике.
+    """
+
+    def __init__(self, locks: KeyedLock):
+        self._locks = locks
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        user: Optional[User] = data.get("event_from_user")
+        if user is None:
+            return await handler(event, data)
+
+        async with self._locks.lock(user.id):
+            return await handler(event, data)
+
+
+# Глобальная таблица блокировок пользователей
+user_locks = KeyedLock()
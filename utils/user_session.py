@@ -0,0 +1,167 @@
+import copy
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject, User
+
+from database import db
+
+session_log = logging.getLogger(__name__)
+
+USER_SESSION_TTL = 30  # Сколько секунд документ пользователя считается актуальным
+USER_SESSION_MAX_USERS = 10_000  # Максимум пользователей в кэше
+
+
+class UserSession:
+    """
+    Документ пользователя в рамках одного обновления.
+    Загружается из кэша или базы при первом обращении; изменения через update()
+    копятся как «грязные» поля и записываются одним update_user после обработчика.
+    """
+
+    def __init__(self, store: "UserSessionStore", user_id: int):
+        self._store = store
+        self.user_id = user_id
+        self._user: Optional[dict] = None
+        self._loaded = False
+        self._dirty: Dict[str, Any] = {}
+
+    @property
+    def dirty(self) -> bool:
+        return bool(self._dirty)
+
+    async def get(self) -> Optional[dict]:
+        """Документ пользователя (None, если пользователя нет)"""
+        if not self._loaded:
+            self._user = await self._store.load(self.user_id)
+            self._loaded = True
+        return self._user
+
+    async def create(self, user: dict) -> Optional[dict]:
+        """Создаёт пользователя в базе сразу, чтобы последующие update_user его нашли"""
+        created = await db.create_user(user)
+        if created:
+            self._user, self._loaded = created, True
+            self._store.put(self.user_id, created)
+        return created
+
+    def update(self, **fields):
+        """Меняет поля документа; в базу они попадут при save()"""
+        if self._user is None:
+            raise RuntimeError("User session is not loaded")
+        self._user.update(fields)
+        self._dirty.update(fields)
+
+    def refresh(self, fields: dict):
+        """Принимает поля, уже записанные атомарной операцией в базе (без повторной записи)"""
+        if self._user is None:
+            raise RuntimeError("User session is not loaded")
+        self._user.update(fields)
+        for field in fields:
+            self._dirty.pop(field, None)
+        self._store.put(self.user_id, self._user)
+
+    async def save(self) -> bool:
+        """Записывает только изменённые поля"""
+        if not self._dirty:
+            return True
+        fields, self._dirty = self._dirty, {}
+        saved = await db.update_user(self.user_id, fields)
+        if saved and self._user is not None:
+            self._store.put(self.user_id, self._user)
+        else:
+            self._store.invalidate("users", self.user_id)
+        return saved
+
+
+class UserSessionStore:
+    """
+    LRU-кэш документов пользователей с TTL.
+    Записи этого процесса сбрасывают запись кэша через write listener базы;
+    TTL ограничивает устаревание при записи из других экземпляров бота.
+    """
+
+    def __init__(self, ttl: float = USER_SESSION_TTL, max_users: int = USER_SESSION_MAX_USERS):
+        self._ttl = ttl
+        self._max_users = max_users
+        self._cache: "OrderedDict[int, tuple]" = OrderedDict()  # {user_id: (loaded_at, user)}
+
+    def __len__(self) -> int:
+        return len(self._cache)
+
+    def put(self, user_id: int, user: dict):
+        self._cache[user_id] = (time.monotonic(), copy.deepcopy(user))
+        self._cache.move_to_end(user_id)
+        while len(self._cache) > self._max_users:
+            self._cache.popitem(last=False)
+
+    async def load(self, user_id: int) -> Optional[dict]:
+        cached = self._cache.get(user_id)
+        if cached is not None and time.monotonic() - cached[0] < self._ttl:
+            self._cache.move_to_end(user_id)
+            return copy.deepcopy(cached[1])
+
+        user = await db.get_user(user_id)
+        if user is None:
+            self._cache.pop(user_id, None)
+        else:
+            self.put(user_id, user)
+        return user
+
+    def invalidate(self, collection: str = None, key=None):
+        """Write listener базы: сбрасывает пользователя (или весь кэш, если ключ неизвестен)"""
+        if collection not in (None, "users"):
+            return
+        if key is None:
+            self._cache.clear()
+        else:
+            self._cache.pop(key, None)
+
+    def start(self):
+        db.add_write_listener(self.invalidate)
+
+    def stop(self):
+        db.remove_write_listener(self.invalidate)
+        self._cache.clear()
+
+
+class UserSessionMiddleware(BaseMiddleware):
+    """
+    Передаёт в обработчик session: UserSession для автора обновления.
+    Изменённые поля записываются после успешного завершения обработчика.
+    Обновления одного пользователя не пересекаются благодаря UserLockMiddleware (utils/user_lock.py).
+    """
+
+    def __init__(self, store: UserSessionStore):
+        self._store = store
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        user: Optional[User] = data.get("event_from_user")
+        if user is None:
+            return await handler(event, data)
+
+        session = UserSession(self._store, user.id)
+        data["session"] = session
+        try:
+            result = await handler(event, data)
+        except Exception:
+            # Незаписанные изменения отбрасываются вместе с закэшированным документом
+            self._store.invalidate("users", user.id)
+            raise
+        try:
+            await session.save()
+        except Exception as e:
+            session_log.error(f"Не удалось сохранить пользователя {user.id}: {e}")
+        return result
+
+
+# Глобальный кэш пользовательских сессий
+user_sessions = UserSessionStore()
@@ -0,0 +1,85 @@
+import asyncio
+import hmac
+import logging
+from typing import Set
+
+from aiohttp import web
+from aiogram import Bot, Dispatcher
+
+webhook_log = logging.getLogger(__name__)
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+class WebhookServer:
+    """
+    aiohttp-приложение для приёма обновлений Telegram через webhook.
+    Обновления обрабатываются в фоновых задачах, чтобы Telegram сразу получал 200;
+    при остановке сервер перестаёт принимать новые обновления и дожидается текущих.
+    Запросы без верного секретного заголовка отклоняются, поэтому секрет обязателен.
+    """
+
+    def __init__(self, dp: Dispatcher, bot: Bot, path: str, secret: str):
+        if not secret:
+            raise ValueError("Webhook secret token must be set")
+        self._dp = dp
+        self._bot = bot
+        self._path = path
+        self._secret = secret
+        self._tasks: Set[asyncio.Task] = set()
+        self._accepting = True
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._tasks)
+
+    def build_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post(self._path, self.handle_update)
+        app.router.add_get("/health", self.handle_health)
+        return app
+
+    async def handle_update(self, request: web.Request) -> web.Response:
+        token = request.headers.get(SECRET_HEADER, "")
+        if not hmac.compare_digest(token.encode(), self._secret.encode()):
+            webhook_log.warning("Webhook request with invalid secret token rejected")
+            return web.Response(status=401)
+
+        if not self._accepting:
+            # Telegram повторит доставку, когда поднимется новый экземпляр
+            return web.Response(status=503)
+
+        try:
+            update = await request.json()
+        except Exception:
+            return web.Response(status=400)
+
+        task = asyncio.create_task(self._dp.feed_raw_update(self._bot, update))
+        self._tasks.add(task)
+        task.add_done_callback(self._on_task_done)
+        return web.Response()
+
+    async def handle_health(self, request: web.Request) -> web.Response:
+        return web.json_response({
+            "status": "ok" if self._accepting else "draining",
+            "in_flight": self.in_flight
+        })
+
+    def _on_task_done(self, task: asyncio.Task):
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            webhook_log.error(f"Error while processing update: {task.exception()}")
+
+    async def drain(self, timeout: float):
+        """Прекращает приём обновлений и ждёт завершения уже принятых"""
+        self._accepting = False
+        if not self._tasks:
+            return
+
+        webhook_log.info(f"Draining {len(self._tasks)} in-flight updates")
+        _, pending = await asyncio.wait(set(self._tasks), timeout=timeout)
+        if pending:
+            webhook_log.warning(f"{len(pending)} updates did not finish within {timeout}s, cancelling")
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)